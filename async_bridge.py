@@ -0,0 +1,57 @@
+"""
+Bridge between synchronous callers (the Streamlit script thread) and a
+long-lived asyncio event loop.
+
+All graph executions in async mode run on a single loop in a background
+thread, so an in-flight LLM call costs a coroutine rather than a blocked
+worker thread. The sync side only waits on a queue for streamed items.
+"""
+
+import asyncio
+import threading
+from queue import Queue
+from typing import Any, AsyncIterator, Coroutine, Iterator, TypeVar
+
+T = TypeVar("T")
+
+_DONE = object()
+
+class _Raised:
+    def __init__(self, error: BaseException):
+        self.error = error
+
+class AsyncBridge:
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name="async-bridge", daemon=True)
+        self.thread.start()
+
+    def run(self, coro: Coroutine[Any, Any, T]) -> T:
+        """Run a coroutine on the bridge loop and block until it is done."""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    def iterate(self, stream: AsyncIterator[T]) -> Iterator[T]:
+        """Consume an async iterator on the bridge loop, yielding its items synchronously."""
+        queue: Queue = Queue()
+
+        async def pump():
+            try:
+                async for item in stream:
+                    queue.put(item)
+            except BaseException as e:
+                queue.put(_Raised(e))
+            finally:
+                queue.put(_DONE)
+
+        future = asyncio.run_coroutine_threadsafe(pump(), self.loop)
+        try:
+            while True:
+                item = queue.get()
+                if item is _DONE:
+                    break
+                if isinstance(item, _Raised):
+                    raise item.error
+                yield item
+        finally:
+            if not future.done():
+                future.cancel()
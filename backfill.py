@@ -0,0 +1,277 @@
+"""
+Bulk scoring of naughty/nice actions, for importing a backlog of actions and
+for re-scoring them after the scoring prompt or examples have changed.
+
+    DB_URI=postgresql://... python backfill.py --input actions.jsonl --results results.jsonl [--apply]
+    DB_URI=postgresql://... python backfill.py --query "SELECT name, action FROM actions" --results results.jsonl --apply
+
+Actions are (name, action) rows from a CSV file with a header or a JSON Lines
+file, both with "name" and "action", or from a query that is streamed with a
+server-side cursor. Actions are deduplicated on the `normalize_action` key,
+the same key as the score cache, so every distinct action is scored once,
+with at most `concurrency` scoring calls in flight. Every occurrence still
+counts when the scores are applied.
+
+The results file is both the output and the progress log. Every score is
+appended as soon as it is returned, so a rerun with the same file only scores
+what is missing. With --apply, once every distinct action has a score, the
+summed deltas per name are written with `ScoreStore.add_deltas`, `batch_size`
+names per upsert. Each applied batch is recorded in the results file, so a
+rerun does not apply it twice. A new input needs a new results file.
+
+With --previous, the results file of an earlier run, an action that was
+scored then only adds the difference between its new and its old score. This
+is how a backlog is re-scored after a prompt change.
+"""
+
+import argparse
+import asyncio
+import csv
+import json
+import logging
+import os
+import time
+from collections import defaultdict
+from typing import AsyncIterator, Iterator, Optional
+
+from score_cache import normalize_action
+from score_store import ScoreDelta, ScoreStore
+
+logger = logging.getLogger(__name__)
+
+def read_file(path: str) -> Iterator[tuple[str, str]]:
+    with open(path, newline="", encoding="utf-8") as f:
+        rows = csv.DictReader(f) if path.endswith(".csv") else (json.loads(line) for line in f if line.strip())
+        for row in rows:
+            yield row["name"], row["action"]
+
+async def aread_file(path: str) -> AsyncIterator[tuple[str, str]]:
+    for row in read_file(path):
+        yield row
+
+async def aread_query(db_uri: str, query: str) -> AsyncIterator[tuple[str, str]]:
+    """The rows of a query that selects name and action, in that order."""
+    import psycopg
+
+    async with await psycopg.AsyncConnection.connect(db_uri) as conn:
+        # A named cursor streams the rows instead of fetching the whole table
+        async with conn.cursor(name="backfill_actions") as cursor:
+            await cursor.execute(query)
+            async for name, action in cursor:
+                yield name, action
+
+class ResultsLog:
+    """
+    Scores by action key and the names that have been applied, appended to a
+    JSON Lines file as they happen. Without a path nothing is written, and
+    with `append=False` an existing file is only read.
+    """
+    def __init__(self, path: Optional[str] = None, append: bool = True):
+        self.path = path
+        self.scores: dict[str, float] = {}
+        self.applied: set[str] = set()
+        self._file = None
+        if path and os.path.exists(path):
+            self._load(path, append)
+        if path and append:
+            self._file = open(path, "a", encoding="utf-8")
+
+    def _load(self, path: str, repair: bool):
+        with open(path, encoding="utf-8") as f:
+            content = f.read()
+        lines = content.split("\n")
+        if not content.endswith("\n"):
+            # The last line was cut off by a crash; that action is scored again
+            lines = lines[:-1]
+            if repair:
+                with open(path, "w", encoding="utf-8") as f:
+                    f.write("".join(line + "\n" for line in lines))
+        for line in lines:
+            if not line:
+                continue
+            entry = json.loads(line)
+            if "applied" in entry:
+                self.applied.update(entry["applied"])
+            else:
+                self.scores[entry["key"]] = entry["nice_score"]
+
+    def add_score(self, key: str, action: str, nice_score: float):
+        self.scores[key] = nice_score
+        self._write({ "key": key, "action": action, "nice_score": nice_score })
+
+    def add_applied(self, names: list[str]):
+        self.applied.update(names)
+        self._write({ "applied": names })
+
+    def _write(self, entry: dict):
+        if self._file:
+            self._file.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            self._file.flush()
+
+    def close(self):
+        if self._file:
+            self._file.close()
+
+class Backfill:
+    """`llm_gateway`, if given, is put in the scorer's config, so the scoring calls are rate limited."""
+    def __init__(self, scorer, concurrency: int = 8, batch_size: int = 500, progress_interval: float = 10, llm_gateway=None):
+        self.scorer = scorer
+        self.llm_gateway = llm_gateway
+        self.concurrency = concurrency
+        self.batch_size = batch_size
+        self.progress_interval = progress_interval
+        # Occurrences of each action key per name
+        self.occurrences: dict[tuple[str, str], int] = defaultdict(int)
+        self.rows = 0
+        self.distinct = 0
+        self.resumed = 0
+        self.scored = 0
+        self.failed = 0
+        self.scoring_seconds = 0.0
+        self._started = 0.0
+        self._reported = 0.0
+
+    async def score(self, actions: AsyncIterator[tuple[str, str]], results: ResultsLog):
+        """Score every distinct action that has no score in `results` yet."""
+        config = { "tags": ["backfill"], "configurable": { "llm_gateway": self.llm_gateway } }
+        semaphore = asyncio.Semaphore(self.concurrency)
+        tasks: set[asyncio.Task] = set()
+        seen: set[str] = set()
+
+        async def score_one(key: str, name: str, action: str):
+            try:
+                nice_score = await self.scorer.ascore(name, action, config)
+            except Exception:
+                # Left out of the results, so a rerun tries it again
+                self.failed += 1
+                logger.exception("Failed to score %r", action)
+            else:
+                results.add_score(key, action, nice_score)
+                self.scored += 1
+            finally:
+                semaphore.release()
+                self._report_progress()
+
+        self._started = self._reported = time.perf_counter()
+        async for name, action in actions:
+            self.rows += 1
+            key = normalize_action(name, action)
+            self.occurrences[(name, key)] += 1
+            if key in seen:
+                continue
+            seen.add(key)
+            self.distinct += 1
+            if key in results.scores:
+                self.resumed += 1
+                continue
+            # Stops reading the input while `concurrency` calls are in flight
+            await semaphore.acquire()
+            task = asyncio.create_task(score_one(key, name, action))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        if tasks:
+            await asyncio.gather(*tasks)
+        self.scoring_seconds = time.perf_counter() - self._started
+        logger.info(
+                "Scored %s distinct actions from %s rows in %.1f s (%s resumed, %s failed)",
+                self.scored, self.rows, self.scoring_seconds, self.resumed, self.failed)
+
+    def _report_progress(self):
+        now = time.perf_counter()
+        if now - self._reported >= self.progress_interval:
+            self._reported = now
+            logger.info(
+                    "%s rows read, %s distinct, %s scored (%.1f/s), %s failed",
+                    self.rows, self.distinct, self.scored, self.scored / (now - self._started), self.failed)
+
+    def deltas(self, results: ResultsLog, previous: Optional[dict[str, float]] = None) -> list[ScoreDelta]:
+        """The summed delta and number of new updates per name, for the names not applied yet."""
+        previous = previous or {}
+        sums: dict[str, list] = defaultdict(lambda: [0.0, 0])
+        for (name, key), count in self.occurrences.items():
+            if name in results.applied:
+                continue
+            sums[name][0] += (results.scores[key] - previous.get(key, 0.0)) * count
+            # A re-scored action replaces an earlier update instead of adding one
+            sums[name][1] += 0 if key in previous else count
+        return [(name, delta, updates) for name, (delta, updates) in sorted(sums.items()) if delta or updates]
+
+    async def apply(self, score_store: ScoreStore, results: ResultsLog, previous: Optional[dict[str, float]] = None) -> int:
+        """Write the deltas with one upsert per batch, and return the number of names."""
+        missing = { key for _, key in self.occurrences } - results.scores.keys()
+        if missing:
+            raise RuntimeError(f"{len(missing)} actions have no score, run the backfill again before applying")
+        deltas = self.deltas(results, previous)
+        for start in range(0, len(deltas), self.batch_size):
+            batch = deltas[start:start + self.batch_size]
+            await score_store.aadd_deltas(batch)
+            results.add_applied([name for name, _, _ in batch])
+            logger.info("Applied %s/%s names", start + len(batch), len(deltas))
+        return len(deltas)
+
+async def main(args) -> int:
+    from llm_gateway import BACKGROUND, LLMGateway
+    from runtime import acreate_pool, acreate_score_store
+    from score_store import SQLiteScoreStore
+    from scoring import LLMScorer, LocalScorer
+
+    backfill = Backfill(
+            LocalScorer() if args.local else LLMScorer(priority=BACKGROUND),
+            concurrency=args.concurrency,
+            batch_size=args.batch_size,
+            progress_interval=args.progress_interval,
+            llm_gateway=LLMGateway(
+                    requests_per_minute=args.requests_per_minute,
+                    tokens_per_minute=args.tokens_per_minute,
+                    max_concurrency=None))
+    actions = aread_query(os.environ["DB_URI"], args.query) if args.query else aread_file(args.input)
+    results = ResultsLog(args.results)
+    try:
+        await backfill.score(actions, results)
+        print(f"{backfill.rows} rows, {backfill.distinct} distinct actions: "
+              f"{backfill.scored} scored, {backfill.resumed} resumed, {backfill.failed} failed")
+        if backfill.scoring_seconds:
+            print(f"{backfill.scoring_seconds:.1f} s, {backfill.scored / backfill.scoring_seconds:.1f} actions/s, "
+                  f"{backfill.rows / backfill.scoring_seconds:.1f} rows/s")
+        if backfill.failed:
+            return 1
+        if not args.apply:
+            return 0
+
+        if args.score_store == "sqlite":
+            score_store = SQLiteScoreStore(args.score_store_path)
+        else:
+            score_store = await acreate_score_store(await acreate_pool(os.environ["DB_URI"], 1))
+        try:
+            previous = ResultsLog(args.previous, append=False).scores if args.previous else None
+            started = time.perf_counter()
+            names = await backfill.apply(score_store, results, previous)
+            print(f"Applied {names} names in {time.perf_counter() - started:.1f} s")
+        finally:
+            await score_store.aclose()
+    finally:
+        results.close()
+    return 0
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Gi poeng til mange handlinger på en gang")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--input", help="CSV or JSON Lines file with name and action")
+    source.add_argument("--query", help="query on DB_URI that selects name and action")
+    parser.add_argument("--results", help="JSON Lines file with the scores, resumes from it if it exists")
+    parser.add_argument("--previous", help="results file of an earlier run, to apply only the score differences")
+    parser.add_argument("--apply", action="store_true", help="add the scores to the score store")
+    parser.add_argument("--concurrency", type=int, default=8, help="scoring calls in flight")
+    parser.add_argument("--requests-per-minute", type=float, help="limit for the scoring calls, none by default")
+    parser.add_argument("--tokens-per-minute", type=float, help="limit for the scoring calls, none by default")
+    parser.add_argument("--batch-size", type=int, default=500, help="names per upsert")
+    parser.add_argument("--progress-interval", type=float, default=10, help="seconds between progress lines")
+    parser.add_argument("--local", action="store_true", help="score with LocalScorer instead of the LLM")
+    parser.add_argument("--score-store", choices=["postgres", "sqlite"], default="postgres")
+    parser.add_argument("--score-store-path", default="scores.db")
+    args = parser.parse_args()
+    if args.apply and not args.results:
+        parser.error("--apply needs --results, so a rerun does not apply the scores twice")
+
+    logging.basicConfig(level=logging.INFO)
+    raise SystemExit(asyncio.run(main(args)))
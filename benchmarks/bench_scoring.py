@@ -0,0 +1,77 @@
+"""
+Micro-benchmark of the per-call overhead of scoring an action, with the LLM
+stubbed out so only prompt and chain construction is measured.
+
+    python -m benchmarks.bench_scoring [--calls 2000]
+
+"rebuild per call" is what `register_naughty_or_nice` used to do: build the
+examples, the template and the `prompt | llm` chain on every invocation.
+"precompiled template" builds the template chain once, and "precompiled
+messages" is `LLMScorer`, which skips the template formatting.
+"""
+
+import argparse
+import time
+
+from langchain_core.messages import AIMessage, HumanMessage
+from langchain_core.prompts import ChatPromptTemplate
+from langchain_core.runnables import RunnableLambda
+
+from score_cache import ScoreCache
+from scoring import SCORING_EXAMPLES, SCORING_SYSTEM_PROMPT, CachedScorer, LLMScorer, LocalScorer
+
+stub_llm = RunnableLambda(lambda prompt: {"nice_score": 5})
+
+def rebuild_per_call(name: str, action: str, config: dict) -> float:
+    examples = [
+        HumanMessage("Jeg har støvsuget.", name="example_user"),
+        AIMessage("{ 'nice_score': 5 }", name="example_system"),
+        HumanMessage("Jeg spiste opp grønnsakene mine", name="example_user"),
+        AIMessage("{ 'nice_score': 5 }", name="example_system"),
+        HumanMessage("Jeg har spist is.", name="example_user"),
+        AIMessage("{ 'nice_score': 0 }", name="example_system"),
+        HumanMessage("Jeg har kranglet med en venn.", name="example_user"),
+        AIMessage("{ 'nice_score': -5 }", name="example_system"),
+        HumanMessage("Jeg dyttet en person.", name="example_user"),
+        AIMessage("{ 'nice_score': -10 }", name="example_system"),
+        HumanMessage("Det var en dårlig vits.", name="example_user"),
+        AIMessage("{ 'nice_score': -5 }", name="example_system"),
+    ]
+    prompt = ChatPromptTemplate.from_messages([
+        ("system", SCORING_SYSTEM_PROMPT),
+        ("placeholder", "{examples}"),
+        ("human", "{input}")])
+    llm_chain = prompt | stub_llm
+    return float(llm_chain.invoke({"input": f"{name}: {action}", "examples": examples}, config)["nice_score"])
+
+template_chain = ChatPromptTemplate.from_messages([
+    ("system", SCORING_SYSTEM_PROMPT),
+    ("placeholder", "{examples}"),
+    ("human", "{input}")]) | stub_llm
+
+def precompiled_template(name: str, action: str, config: dict) -> float:
+    return float(template_chain.invoke({"input": f"{name}: {action}", "examples": SCORING_EXAMPLES}, config)["nice_score"])
+
+def measure(score, calls: int) -> float:
+    config = { "configurable": {} }
+    score("Per", "Jeg har støvsuget.", config)  # warm up
+    start = time.perf_counter()
+    for i in range(calls):
+        score("Per", f"Jeg har støvsuget {i % 50} ganger.", config)
+    return (time.perf_counter() - start) / calls
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--calls", type=int, default=2000)
+    args = parser.parse_args()
+
+    scorers = [
+        ("rebuild per call", rebuild_per_call),
+        ("precompiled template", precompiled_template),
+        ("precompiled messages", LLMScorer(stub_llm).score),
+        ("cached (50 distinct)", CachedScorer(LLMScorer(stub_llm), ScoreCache()).score),
+        ("local", LocalScorer().score),
+    ]
+    for label, score in scorers:
+        per_call = measure(score, args.calls)
+        print(f"{label:<28} {per_call * 1e6:10.1f} µs/call")
@@ -0,0 +1,145 @@
+"""
+Import time and time to first render of the Streamlit app.
+
+    python -m benchmarks.bench_startup [--repeat 5] [--top 12]
+    DB_URI=postgresql://... python -m benchmarks.bench_startup --render [--async]
+
+The import breakdown runs `python -X importtime` in fresh interpreters for
+two stages: "first render" is every module main.py imports at load, which
+is all that is needed for the title, image and leaderboard, and "graph" is
+what get_runtime imports on top of that (the graph, LangChain, LangGraph
+and the OpenAI client). Each stage lists the packages with the most
+cumulative import time.
+
+With --render the app is run with Streamlit's AppTest in a fresh
+interpreter, and the report has the time from interpreter start until the
+leaderboard is rendered (when the sidebar has its scores, before get_runtime
+loads the graph), until the first script run has finished, and of a warm
+rerun. No message is sent, so no OpenAI call is made.
+"""
+
+import argparse
+import ast
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+from collections import defaultdict
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+STAGE_MARKER = "-- bench_startup stage --"
+
+# Imported by get_runtime and the santa node, langchain_openai only on first use
+GRAPH_MODULES = ["runtime", "context_window", "scoring", "julenissen", "instrumentation", "langchain_openai"]
+
+def app_modules() -> list[str]:
+    """The modules main.py imports at load, outside functions and TYPE_CHECKING blocks."""
+    with open(os.path.join(ROOT, "main.py")) as f:
+        tree = ast.parse(f.read())
+    modules = []
+    for node in tree.body:
+        if isinstance(node, ast.Import):
+            modules.extend(alias.name for alias in node.names)
+        elif isinstance(node, ast.ImportFrom) and node.module:
+            modules.append(node.module)
+    return modules
+
+def parse_importtime(lines: list[str]) -> dict[str, float]:
+    """Cumulative seconds per top-level package, from the top-level entries of -X importtime."""
+    packages: dict[str, float] = defaultdict(float)
+    for line in lines:
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        if name.startswith("  "):
+            continue  # Nested, already in the cumulative time of its parent
+        packages[name.strip().split(".")[0]] += int(cumulative) / 1e6
+    return packages
+
+def measure_imports() -> tuple[dict[str, float], dict[str, float]]:
+    code = "; ".join([
+        *(f"import {module}" for module in app_modules()),
+        f"import sys; sys.stderr.write({STAGE_MARKER!r} + '\\n')",
+        *(f"import {module}" for module in GRAPH_MODULES),
+    ])
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", code], cwd=ROOT, capture_output=True, text=True, check=True)
+    lines = result.stderr.splitlines()
+    split = lines.index(STAGE_MARKER)
+    return parse_importtime(lines[:split]), parse_importtime(lines[split + 1:])
+
+RENDER_CHILD = """
+import json, os, sys, time
+started = time.perf_counter()
+sys.path.insert(0, os.getcwd())
+from streamlit.testing.v1 import AppTest
+from leaderboard import Leaderboard
+
+# main.py runs as a script under AppTest, so the mark is on the leaderboard read
+# that fills the sidebar, right before get_runtime
+marks = {}
+get, aget = Leaderboard.get, Leaderboard.aget
+def mark_get(self, score_store):
+    scores = get(self, score_store)
+    marks.setdefault("first_render", time.perf_counter() - started)
+    return scores
+async def mark_aget(self, score_store):
+    scores = await aget(self, score_store)
+    marks.setdefault("first_render", time.perf_counter() - started)
+    return scores
+Leaderboard.get, Leaderboard.aget = mark_get, mark_aget
+
+app = AppTest.from_file("main.py", default_timeout=120)
+app.secrets["db_uri"] = os.environ["DB_URI"]
+app.secrets["async_mode"] = os.environ.get("BENCH_ASYNC") == "1"
+app.secrets["checkpoint_retention"] = False
+app.run()
+marks["first_run"] = time.perf_counter() - started
+assert not app.exception, app.exception
+assert app.title[0].value == "Chat med julenissen"
+rerun_started = time.perf_counter()
+app.run()
+marks["rerun"] = time.perf_counter() - rerun_started
+print(json.dumps(marks))
+"""
+
+def measure_render(use_async: bool) -> dict[str, float]:
+    env = { **os.environ, "BENCH_ASYNC": "1" if use_async else "0" }
+    env.setdefault("OPENAI_API_KEY", "sk-bench")
+    result = subprocess.run([sys.executable, "-c", RENDER_CHILD], cwd=ROOT, env=env, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr)
+    return json.loads(result.stdout.splitlines()[-1])
+
+def report_stage(label: str, runs: list[dict[str, float]], top: int):
+    totals = [sum(packages.values()) for packages in runs]
+    print(f"{label}: {statistics.median(totals) * 1000:.0f} ms (median of {len(runs)}, min {min(totals) * 1000:.0f} ms)")
+    packages = defaultdict(list)
+    for run in runs:
+        for name, seconds in run.items():
+            packages[name].append(seconds)
+    ranked = sorted(packages.items(), key=lambda item: -statistics.median(item[1]))
+    for name, seconds in ranked[:top]:
+        print(f"  {name:<28} {statistics.median(seconds) * 1000:8.1f} ms")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--top", type=int, default=12, help="packages to list per stage")
+    parser.add_argument("--render", action="store_true", help="also time the first render with AppTest, needs DB_URI")
+    parser.add_argument("--async", dest="use_async", action="store_true", help="render with async_mode")
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    first_render, graph = zip(*(measure_imports() for _ in range(args.repeat)))
+    report_stage("Imports before first render", list(first_render), args.top)
+    report_stage("Imports for the graph", list(graph), args.top)
+
+    if args.render:
+        renders = [measure_render(args.use_async) for _ in range(args.repeat)]
+        print()
+        for key, label in [("first_render", "Leaderboard rendered"), ("first_run", "First run finished"), ("rerun", "Warm rerun")]:
+            values = [render[key] for render in renders]
+            print(f"{label:<22} p50 {statistics.median(values) * 1000:7.0f} ms   max {max(values) * 1000:7.0f} ms")
+    print(f"\n({time.perf_counter() - started:.1f} s)")
@@ -0,0 +1,65 @@
+"""
+LLM calls, tool statements and wall-clock time per turn, for a turn where
+the user reports an action.
+
+    DB_URI=postgresql://... python -m benchmarks.bench_tool_round_trips [--turns 20] [--latency 0.3]
+
+"register + check" is the old flow: the model registers the action, checks
+the list again as the system prompt asked, and then answers. "single round"
+is the current flow: the register tool answers with the new standing and the
+santa call after a tool round cannot make further tool calls. Scoring uses
+LocalScorer, so only santa calls hit the (fake) LLM.
+"""
+
+import argparse
+import os
+import time
+
+from benchmarks.harness import Counter, ScriptedChatModel, StatementCounter, santa_script
+
+from langgraph.checkpoint.memory import MemorySaver
+from psycopg_pool import ConnectionPool
+
+import julenissen
+from runtime import CONNECTION_KWARGS
+from score_store import PostgresScoreStore
+from scoring import LocalScorer
+
+def run(label: str, score_store: PostgresScoreStore, statements: StatementCounter, turns: int, latency: float, single_tool_round: bool):
+    llm_calls = Counter()
+    model = ScriptedChatModel(script=santa_script(check_after_register=True), latency=latency, counter=llm_calls)
+    julenissen.llm_with_tools = model.bind_tools(julenissen.tools)
+    julenissen.llm_final = model.bind_tools(julenissen.tools, tool_choice="none")
+
+    graph = julenissen.graph_builder.compile(checkpointer=MemorySaver())
+    config = { "configurable": {
+        "thread_id": label,
+        "score_store": score_store,
+        "scorer": LocalScorer(),
+        "single_tool_round": single_tool_round,
+    } }
+
+    statements.count = 0
+    start = time.perf_counter()
+    for i in range(turns):
+        graph.invoke({ "messages": [("user", f"__bench_{i % 3}: Jeg har støvsuget")] }, config)
+    elapsed = time.perf_counter() - start
+
+    print(f"{label:<18} {llm_calls.count / turns:5.1f} LLM calls/turn   "
+          f"{statements.count / turns:5.1f} tool statements/turn   "
+          f"{elapsed / turns * 1e3:8.1f} ms/turn")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--turns", type=int, default=20)
+    parser.add_argument("--latency", type=float, default=0.3, help="fake LLM latency per call, in seconds")
+    args = parser.parse_args()
+
+    statements = StatementCounter()
+    with ConnectionPool(os.environ["DB_URI"], kwargs=statements.counting_kwargs(CONNECTION_KWARGS)) as pool:
+        score_store = PostgresScoreStore(pool)
+        score_store.setup()
+        run("register + check", score_store, statements, args.turns, args.latency, single_tool_round=False)
+        run("single round", score_store, statements, args.turns, args.latency, single_tool_round=True)
+        with pool.connection() as conn:
+            conn.execute("DELETE FROM naughty_nice WHERE starts_with(name, '__bench_')")
@@ -0,0 +1,129 @@
+"""
+Contention benchmark: per-call score upserts vs. write-behind batched flushes.
+
+N worker threads register scores for a small set of hot names, like many
+sessions all named "Per". Needs a Postgres database:
+
+    DB_URI=postgresql://... python -m benchmarks.bench_write_behind [--threads 32] [--updates 200] [--names 3]
+
+The benchmark rows use the name prefix "__bench_" and are deleted afterwards.
+Before the benchmark, a check on an in-memory SQLite store with a slow
+commit makes sure that reads during a flush neither lose nor double count
+the delta that is being flushed.
+"""
+
+import argparse
+import os
+import statistics
+import threading
+import time
+
+from psycopg_pool import ConnectionPool
+
+from runtime import CONNECTION_KWARGS
+from score_store import PostgresScoreStore, SQLiteScoreStore
+from write_behind import ScoreWriteBehind
+
+class SlowCommitStore(SQLiteScoreStore):
+    """Holds the flush open before and after the commit, where reads used to go wrong."""
+    def add_deltas(self, deltas):
+        time.sleep(0.05)
+        scores = super().add_deltas(deltas)
+        time.sleep(0.05)
+        return scores
+
+def check_reads_during_flush():
+    score_store = SlowCommitStore()
+    score_store.add_delta("__bench_read", 10.0)
+    write_behind = ScoreWriteBehind()
+    write_behind.add("__bench_read", 5.0)
+    flusher = threading.Thread(target=write_behind.flush, args=(score_store,))
+    flusher.start()
+    reads = []
+
+    def read(delay: float):
+        time.sleep(delay)
+        nice_meter, pending = write_behind.standing("__bench_read", score_store.get)
+        reads.append((nice_meter or 0) + (pending or 0))
+
+    # Before the commit, and after it but before the flush has landed
+    readers = [threading.Thread(target=read, args=(delay,)) for delay in (0.01, 0.03, 0.07, 0.09)]
+    for reader in readers:
+        reader.start()
+    time.sleep(0.02)
+    assert write_behind.pending("__bench_read") == 5.0, "the delta being flushed is not pending"
+    flusher.join()
+    for reader in readers:
+        reader.join()
+    assert set(reads) == {15.0}, f"reads during a flush saw {sorted(set(reads))}"
+    assert write_behind.standing("__bench_read", score_store.get) == (15.0, None)
+    print(f"reads during flush: {len(reads)} reads, all 15")
+
+def run_workers(threads: int, updates: int, names: int, register) -> tuple[float, list[float]]:
+    latencies: list[list[float]] = [[] for _ in range(threads)]
+    barrier = threading.Barrier(threads + 1)
+
+    def worker(index: int):
+        barrier.wait()
+        for i in range(updates):
+            name = f"__bench_{(index + i) % names}"
+            start = time.perf_counter()
+            register(name, 1.0)
+            latencies[index].append(time.perf_counter() - start)
+
+    workers = [threading.Thread(target=worker, args=(i,)) for i in range(threads)]
+    for w in workers:
+        w.start()
+    barrier.wait()
+    start = time.perf_counter()
+    for w in workers:
+        w.join()
+    return time.perf_counter() - start, [latency for thread in latencies for latency in thread]
+
+def report(label: str, elapsed: float, latencies: list[float], statements: int):
+    latencies.sort()
+    p99 = latencies[int(len(latencies) * 0.99) - 1]
+    print(f"{label:<14} {len(latencies) / elapsed:10.0f} updates/s   "
+          f"p50 {statistics.median(latencies) * 1e3:8.3f} ms   p99 {p99 * 1e3:8.3f} ms   "
+          f"{statements} statements")
+
+def total(pool: ConnectionPool) -> float:
+    with pool.connection() as conn:
+        row = conn.execute("SELECT coalesce(sum(nice_meter), 0) AS total FROM naughty_nice WHERE starts_with(name, '__bench_')").fetchone()
+    return float(row["total"])
+
+def cleanup(pool: ConnectionPool):
+    with pool.connection() as conn:
+        conn.execute("DELETE FROM naughty_nice WHERE starts_with(name, '__bench_')")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--threads", type=int, default=32)
+    parser.add_argument("--updates", type=int, default=200, help="updates per thread")
+    parser.add_argument("--names", type=int, default=3, help="number of distinct (hot) names")
+    parser.add_argument("--flush-interval", type=float, default=0.05)
+    args = parser.parse_args()
+
+    check_reads_during_flush()
+
+    expected = float(args.threads * args.updates)
+    with ConnectionPool(os.environ["DB_URI"], min_size=args.threads, max_size=args.threads, kwargs=CONNECTION_KWARGS) as pool:
+        score_store = PostgresScoreStore(pool)
+        score_store.setup()
+        cleanup(pool)
+
+        elapsed, latencies = run_workers(args.threads, args.updates, args.names, score_store.add_delta)
+        assert total(pool) == expected, "per-call upserts lost updates"
+        report("per-call", elapsed, latencies, len(latencies))
+        cleanup(pool)
+
+        write_behind = ScoreWriteBehind(flush_interval=args.flush_interval, max_pending=args.names)
+        write_behind.start(score_store)
+        elapsed, latencies = run_workers(args.threads, args.updates, args.names, write_behind.add)
+        # The final flush is part of the cost
+        start = time.perf_counter()
+        write_behind.close(score_store)
+        elapsed += time.perf_counter() - start
+        assert total(pool) == expected, "write-behind lost updates"
+        report("write-behind", elapsed, latencies, write_behind.flushes)
+        cleanup(pool)
@@ -0,0 +1,149 @@
+"""
+Shared pieces for the benchmarks: a scripted fake chat model with
+configurable latency and streaming, and a statement counter for psycopg
+and SQLite connections.
+"""
+
+import asyncio
+import json
+import threading
+import time
+from typing import Any, AsyncIterator, Callable, Iterator, Optional
+
+from langchain_core.language_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage, HumanMessage, ToolMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+from psycopg import AsyncCursor, Cursor
+
+class ScriptedChatModel(BaseChatModel):
+    """
+    Fake chat model that answers with `script(messages, tool_choice)`.
+
+    The first token arrives after `latency` seconds. When streamed (as the
+    graph does with stream_mode="messages"), text answers are sent word by
+    word with `chunk_latency` seconds between the chunks, and tool calls as a
+    single tool call chunk. `bind_tools` only records the tool_choice, so the
+    same script can tell a normal santa call from a final one.
+    """
+    script: Callable[[list[BaseMessage], Optional[str]], AIMessage]
+    latency: float = 0.0
+    chunk_latency: float = 0.0
+    tool_choice: Optional[str] = None
+    counter: Any = None
+
+    def bind_tools(self, tools, *, tool_choice: Optional[str] = None, **kwargs):
+        return self.model_copy(update={ "tool_choice": tool_choice })
+
+    @property
+    def _llm_type(self) -> str:
+        return "scripted"
+
+    def _next(self, messages: list[BaseMessage]) -> AIMessage:
+        if self.counter is not None:
+            self.counter.add()
+        return self.script(messages, self.tool_choice)
+
+    def _chunks(self, message: AIMessage) -> list[ChatGenerationChunk]:
+        if message.tool_calls:
+            return [ChatGenerationChunk(message=AIMessageChunk(content="", tool_call_chunks=[
+                { "name": call["name"], "args": json.dumps(call["args"]), "id": call["id"], "index": i }
+                for i, call in enumerate(message.tool_calls)
+            ]))]
+        words = message.content.split(" ")
+        return [ChatGenerationChunk(message=AIMessageChunk(content=word if i == 0 else f" {word}")) for i, word in enumerate(words)]
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        time.sleep(self.latency)
+        return ChatResult(generations=[ChatGeneration(message=self._next(messages))])
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        await asyncio.sleep(self.latency)
+        return ChatResult(generations=[ChatGeneration(message=self._next(messages))])
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs) -> Iterator[ChatGenerationChunk]:
+        time.sleep(self.latency)
+        for i, chunk in enumerate(self._chunks(self._next(messages))):
+            if i > 0:
+                time.sleep(self.chunk_latency)
+            yield chunk
+
+    async def _astream(self, messages, stop=None, run_manager=None, **kwargs) -> AsyncIterator[ChatGenerationChunk]:
+        await asyncio.sleep(self.latency)
+        for i, chunk in enumerate(self._chunks(self._next(messages))):
+            if i > 0:
+                await asyncio.sleep(self.chunk_latency)
+            yield chunk
+
+def santa_script(check_after_register: bool):
+    """
+    Script for a turn where the user message is "<name>: <action>". The model
+    registers the action, optionally checks the list again (what the system
+    prompt used to ask for), and then answers.
+    """
+    def script(messages: list[BaseMessage], tool_choice: Optional[str]) -> AIMessage:
+        last = messages[-1]
+        turn = sum(isinstance(m, HumanMessage) for m in messages)
+        if isinstance(last, HumanMessage):
+            name, action = last.content.split(": ", 1)
+            return AIMessage("", tool_calls=[{ "name": "register_naughty_or_nice", "args": { "name": name, "action": action }, "id": f"register-{turn}" }])
+        if isinstance(last, ToolMessage) and last.name == "register_naughty_or_nice" and check_after_register and tool_choice != "none":
+            name = next(m for m in reversed(messages) if isinstance(m, AIMessage) and m.tool_calls).tool_calls[0]["args"]["name"]
+            return AIMessage("", tool_calls=[{ "name": "check_naughty_list", "args": { "name": name }, "id": f"check-{turn}" }])
+        return AIMessage(f"Ho-ho-ho! {last.content}")
+    return script
+
+class Counter:
+    def __init__(self):
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def add(self, n: int = 1):
+        with self._lock:
+            self.count += n
+
+class StatementCounter(Counter):
+    """
+    Counts every statement sent through connections created with
+    `counting_kwargs()`, including the ones the checkpointer makes, and
+    through SQLite connections wrapped with `counting_sqlite()`.
+    """
+
+    def counting_kwargs(self, kwargs: dict, use_async: bool = False) -> dict:
+        """Connection kwargs for a psycopg pool, with a cursor factory that reports to this counter."""
+        counter = self
+
+        class CountingCursor(Cursor):
+            def execute(self, query, params=None, **kwargs):
+                counter.add()
+                return super().execute(query, params, **kwargs)
+
+            def executemany(self, query, params_seq, **kwargs):
+                params_seq = list(params_seq)
+                counter.add(len(params_seq))
+                return super().executemany(query, params_seq, **kwargs)
+
+        class AsyncCountingCursor(AsyncCursor):
+            async def execute(self, query, params=None, **kwargs):
+                counter.add()
+                return await super().execute(query, params, **kwargs)
+
+            async def executemany(self, query, params_seq, **kwargs):
+                params_seq = list(params_seq)
+                counter.add(len(params_seq))
+                return await super().executemany(query, params_seq, **kwargs)
+
+        return { **kwargs, "cursor_factory": AsyncCountingCursor if use_async else CountingCursor }
+
+    def counting_sqlite(self, conn):
+        """A sqlite3 connection whose `execute` reports to this counter."""
+        counter = self
+
+        class CountingConnection:
+            def execute(self, sql, parameters=()):
+                counter.add()
+                return conn.execute(sql, parameters)
+
+            def __getattr__(self, name):
+                return getattr(conn, name)
+
+        return CountingConnection()
@@ -0,0 +1,281 @@
+"""
+Offline load test of the compiled graph, with scripted fake LLMs.
+
+N concurrent sessions each run a number of turns where the user reports an
+action. The santa model and the scoring model are fakes with configurable
+latency, and santa answers are streamed word by word. Tools run against a
+Postgres or an in-memory SQLite score store, the checkpointer is either
+Postgres or in memory. With both in memory no database is needed.
+
+    DB_URI=postgresql://... python -m benchmarks.loadtest [--sessions 20] [--turns 5] [--async] [--checkpointer memory]
+    python -m benchmarks.loadtest --checkpointer memory --score-store sqlite
+    python -m benchmarks.loadtest --pgserver   # throwaway local Postgres, needs `pip install pgserver`
+
+Reports turn latency and time to first token (p50/p95/p99), throughput,
+LLM calls, database statements (tools and checkpointer, Postgres and
+SQLite) and stream frames per turn. The answers pass through the same frame coalescing as the app,
+`--flush-interval 0` sends every token as its own frame. With
+`--llm-rpm`/`--llm-tpm`/`--llm-concurrency` the fake LLM calls go through an
+`LLMGateway` with those limits, and the queue wait per priority is reported.
+The score rows use the name prefix "__bench_" and are deleted afterwards.
+"""
+
+import argparse
+import asyncio
+import contextlib
+import os
+import random
+import statistics
+import tempfile
+import threading
+import time
+from typing import NamedTuple, Optional
+
+from benchmarks.harness import Counter, ScriptedChatModel, StatementCounter, santa_script
+
+from langchain_core.messages import AIMessage
+from langchain_core.runnables import RunnableLambda
+from langgraph.checkpoint.memory import MemorySaver
+from langgraph.checkpoint.postgres import PostgresSaver
+from langgraph.checkpoint.postgres.aio import AsyncPostgresSaver
+from psycopg_pool import AsyncConnectionPool, ConnectionPool
+
+import julenissen
+from context_window import ContextWindow
+from llm_gateway import INTERACTIVE, PRIORITY_LABELS, LLMGateway
+from metrics import LLM_COALESCED, LLM_QUEUE_WAIT_SECONDS
+from runtime import CONNECTION_KWARGS, Runtime
+from score_cache import ScoreCache
+from score_store import PostgresScoreStore, SQLiteScoreStore
+from scoring import CachedScorer, LLMScorer, LocalScorer
+from stream_frames import acoalesce_text, coalesce_text
+
+NAMES = ["Per", "Kari", "Ola", "Nora", "Emma", "Jakob", "Sofie", "Filip"]
+ACTIONS = [
+    "Jeg har støvsuget hele huset",
+    "Jeg spiste opp grønnsakene mine",
+    "Jeg kranglet med broren min",
+    "Jeg dyttet en i køen",
+    "Jeg hjalp bestemor med handlingen",
+    "Den vitsen var dårlig",
+]
+
+CLEANUP = "DELETE FROM naughty_nice WHERE starts_with(name, '__bench_')"
+
+class TurnResult(NamedTuple):
+    latency: float
+    ttft: Optional[float]
+    frames: int
+
+def fake_scoring_llm(latency: float, calls: Counter):
+    """Structured output stand-in: scores the last human message with LocalScorer."""
+    local = LocalScorer()
+
+    def score(messages):
+        calls.add()
+        name, action = messages[-1].content.split(": ", 1)
+        return { "nice_score": local.score(name, action, {}) }
+
+    def sync_score(messages):
+        time.sleep(latency)
+        return score(messages)
+
+    async def async_score(messages):
+        await asyncio.sleep(latency)
+        return score(messages)
+
+    return RunnableLambda(sync_score, afunc=async_score)
+
+def install_fake_models(args, llm_calls: Counter):
+    model = ScriptedChatModel(
+            script=santa_script(check_after_register=False),
+            latency=args.latency,
+            chunk_latency=args.chunk_latency,
+            counter=llm_calls)
+    julenissen.llm_with_tools = model.bind_tools(julenissen.tools)
+    julenissen.llm_final = model.bind_tools(julenissen.tools, tool_choice="none")
+
+def create_scorer(args, llm_calls: Counter):
+    scorer = LLMScorer(fake_scoring_llm(args.scoring_latency, llm_calls), priority=INTERACTIVE)
+    return CachedScorer(scorer, ScoreCache()) if args.score_cache else scorer
+
+def create_llm_gateway(args) -> Optional[LLMGateway]:
+    if not (args.llm_rpm or args.llm_tpm or args.llm_concurrency):
+        return None
+    return LLMGateway(requests_per_minute=args.llm_rpm, tokens_per_minute=args.llm_tpm, max_concurrency=args.llm_concurrency)
+
+def create_context_window(llm_calls: Counter) -> ContextWindow:
+    summarizer = ScriptedChatModel(script=lambda messages, tool_choice: AIMessage("Sammendrag"), counter=llm_calls)
+    return ContextWindow(summarizer=summarizer)
+
+def create_score_store(args, pool, statements: StatementCounter):
+    if args.score_store == "postgres":
+        return PostgresScoreStore(pool)
+    score_store = SQLiteScoreStore()
+    score_store._conn = statements.counting_sqlite(score_store._conn)
+    return score_store
+
+def uses_postgres(args) -> bool:
+    return args.checkpointer == "postgres" or args.score_store == "postgres"
+
+def turn_input(session: int, turn: int) -> str:
+    rng = random.Random(session * 1000 + turn)
+    return f"__bench_{rng.choice(NAMES)}: {rng.choice(ACTIONS)}"
+
+def run_sync(args, db_uri: Optional[str], statements: StatementCounter, llm_calls: Counter) -> tuple[list[TurnResult], float]:
+    pool = ConnectionPool(db_uri, min_size=1, max_size=args.pool_size, kwargs=statements.counting_kwargs(CONNECTION_KWARGS), open=True) if db_uri else None
+    with pool or contextlib.nullcontext():
+        score_store = create_score_store(args, pool, statements)
+        if args.score_store == "postgres":
+            score_store.setup()
+        if args.checkpointer == "postgres":
+            checkpointer = PostgresSaver(pool)
+            checkpointer.setup()
+        else:
+            checkpointer = MemorySaver()
+        runtime = Runtime(pool, checkpointer, julenissen.graph_builder.compile(checkpointer=checkpointer),
+                          create_scorer(args, llm_calls), create_context_window(llm_calls), score_store=score_store,
+                          llm_gateway=create_llm_gateway(args))
+
+        results: list[TurnResult] = []
+        barrier = threading.Barrier(args.sessions + 1)
+        run_id = random.randint(0, 1000000)
+
+        def session(index: int):
+            config = runtime.config(f"loadtest-{run_id}-{index}")
+            barrier.wait()
+            for turn in range(args.turns):
+                start = time.perf_counter()
+                first_token = None
+                frames = 0
+                stream = runtime.graph.stream({ "messages": [("user", turn_input(index, turn))] }, config, stream_mode="messages")
+                for _ in coalesce_text(stream, flush_interval=args.flush_interval):
+                    frames += 1
+                    first_token = first_token or time.perf_counter()
+                end = time.perf_counter()
+                results.append(TurnResult(end - start, first_token - start if first_token else None, frames))
+
+        threads = [threading.Thread(target=session, args=(i,)) for i in range(args.sessions)]
+        for thread in threads:
+            thread.start()
+        statements.count = 0
+        llm_calls.count = 0
+        barrier.wait()
+        start = time.perf_counter()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+        if args.score_store == "postgres":
+            with pool.connection() as conn:
+                conn.execute(CLEANUP)
+        return results, elapsed
+
+async def run_async(args, db_uri: Optional[str], statements: StatementCounter, llm_calls: Counter) -> tuple[list[TurnResult], float]:
+    pool = AsyncConnectionPool(db_uri, min_size=1, max_size=args.pool_size, kwargs=statements.counting_kwargs(CONNECTION_KWARGS, use_async=True), open=False) if db_uri else None
+    if pool:
+        await pool.open()
+    async with pool or contextlib.nullcontext():
+        score_store = create_score_store(args, pool, statements)
+        if args.score_store == "postgres":
+            await score_store.asetup()
+        if args.checkpointer == "postgres":
+            checkpointer = AsyncPostgresSaver(pool)
+            await checkpointer.setup()
+        else:
+            checkpointer = MemorySaver()
+        runtime = Runtime(pool, checkpointer, julenissen.graph_builder.compile(checkpointer=checkpointer),
+                          create_scorer(args, llm_calls), create_context_window(llm_calls), score_store=score_store,
+                          llm_gateway=create_llm_gateway(args))
+
+        results: list[TurnResult] = []
+        run_id = random.randint(0, 1000000)
+
+        async def session(index: int):
+            config = runtime.config(f"loadtest-{run_id}-{index}")
+            for turn in range(args.turns):
+                start = time.perf_counter()
+                first_token = None
+                frames = 0
+                stream = runtime.graph.astream({ "messages": [("user", turn_input(index, turn))] }, config, stream_mode="messages")
+                async for _ in acoalesce_text(stream, flush_interval=args.flush_interval):
+                    frames += 1
+                    first_token = first_token or time.perf_counter()
+                end = time.perf_counter()
+                results.append(TurnResult(end - start, first_token - start if first_token else None, frames))
+
+        statements.count = 0
+        llm_calls.count = 0
+        start = time.perf_counter()
+        await asyncio.gather(*(session(i) for i in range(args.sessions)))
+        elapsed = time.perf_counter() - start
+        if args.score_store == "postgres":
+            async with pool.connection() as conn:
+                await conn.execute(CLEANUP)
+        return results, elapsed
+
+def percentiles(values: list[float]) -> str:
+    if len(values) < 2:
+        return "n/a"
+    cuts = statistics.quantiles(values, n=100, method="inclusive")
+    return f"p50 {cuts[49] * 1e3:8.1f} ms   p95 {cuts[94] * 1e3:8.1f} ms   p99 {cuts[98] * 1e3:8.1f} ms"
+
+def report(args, results: list[TurnResult], elapsed: float, statements: StatementCounter, llm_calls: Counter):
+    turns = len(results)
+    mode = "async" if args.use_async else "sync"
+    print(f"{args.sessions} sessions x {args.turns} turns ({mode}, {args.checkpointer} checkpointer, {args.score_store} scores): {turns} turns in {elapsed:.2f} s")
+    print(f"throughput          {turns / elapsed:8.2f} turns/s")
+    print(f"turn latency        {percentiles([r.latency for r in results])}")
+    print(f"time to first token {percentiles([r.ttft for r in results if r.ttft is not None])}")
+    print(f"LLM calls/turn      {llm_calls.count / turns:8.2f}")
+    print(f"DB statements/turn  {statements.count / turns:8.2f}")
+    print(f"stream frames/turn  {sum(r.frames for r in results) / turns:8.2f}")
+    for label in PRIORITY_LABELS.values():
+        count, total = LLM_QUEUE_WAIT_SECONDS.count_and_sum(priority=label)
+        if count:
+            print(f"gateway {label:<11} {count} calls, mean queue wait {total / count * 1e3:.1f} ms, {LLM_COALESCED.value(priority=label):.0f} coalesced")
+
+@contextlib.contextmanager
+def database(args):
+    """The Postgres URI, or None when the checkpointer and the score store are in memory."""
+    if not uses_postgres(args):
+        yield None
+        return
+    if not args.pgserver:
+        yield os.environ["DB_URI"]
+        return
+    import pgserver  # Optional, only needed for --pgserver
+    with tempfile.TemporaryDirectory() as data_dir:
+        server = pgserver.get_server(data_dir, cleanup_mode="stop")
+        try:
+            yield server.get_uri()
+        finally:
+            server.cleanup()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sessions", type=int, default=20)
+    parser.add_argument("--turns", type=int, default=5, help="turns per session")
+    parser.add_argument("--latency", type=float, default=0.5, help="santa model time to first token, in seconds")
+    parser.add_argument("--chunk-latency", type=float, default=0.02, help="time between streamed chunks, in seconds")
+    parser.add_argument("--flush-interval", type=float, default=0.05, help="stream frame coalescing interval, in seconds")
+    parser.add_argument("--scoring-latency", type=float, default=0.5, help="scoring model latency, in seconds")
+    parser.add_argument("--score-cache", action="store_true", help="wrap the scorer in a ScoreCache")
+    parser.add_argument("--score-store", choices=["postgres", "sqlite"], default="postgres")
+    parser.add_argument("--checkpointer", choices=["memory", "postgres"], default="postgres")
+    parser.add_argument("--llm-rpm", type=float, help="requests per minute limit in the LLM gateway")
+    parser.add_argument("--llm-tpm", type=float, help="tokens per minute limit in the LLM gateway")
+    parser.add_argument("--llm-concurrency", type=int, help="LLM calls in flight in the LLM gateway")
+    parser.add_argument("--pool-size", type=int, default=10)
+    parser.add_argument("--async", dest="use_async", action="store_true", help="drive the graph with astream on an async pool")
+    parser.add_argument("--pgserver", action="store_true", help="start a throwaway Postgres instead of using DB_URI")
+    args = parser.parse_args()
+
+    statements = StatementCounter()
+    llm_calls = Counter()
+    install_fake_models(args, llm_calls)
+    with database(args) as db_uri:
+        if args.use_async:
+            results, elapsed = asyncio.run(run_async(args, db_uri, statements, llm_calls))
+        else:
+            results, elapsed = run_sync(args, db_uri, statements, llm_calls)
+        report(args, results, elapsed, statements, llm_calls)
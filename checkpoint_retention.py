@@ -0,0 +1,294 @@
+"""
+Retention for the Postgres checkpointer tables.
+
+`PostgresSaver` writes a checkpoint per graph step and never deletes any, and
+every browser session gets a new random thread id. `CheckpointRetention`
+keeps the tables bounded:
+
+- threads with no checkpoint newer than `thread_ttl` seconds are removed
+  from `checkpoints`, `checkpoint_writes` and `checkpoint_blobs`,
+- threads idle for at least `grace` seconds are trimmed to their latest
+  `keep_last` checkpoints, together with the writes and blobs that only the
+  removed checkpoints referenced.
+
+Only idle threads are touched, since `PostgresSaver.put` writes the blobs
+before the checkpoint that references them. With `archive=True` the removed
+rows are moved to `<table>_archive` instead of being deleted.
+
+With `score_cache_ttl` set, each step also deletes up to `batch_size` rows
+of the shared score cache (`score_cache.py`) older than that many seconds.
+
+Each `run`/`arun` handles at most `batch_size` threads per step, so it can
+run incrementally from the app (`start`/`astart`) or as scheduled
+maintenance: `DB_URI=postgresql://... python checkpoint_retention.py --vacuum`
+"""
+
+import argparse
+import asyncio
+import logging
+import os
+import threading
+from typing import Optional
+
+from score_cache import CREATE_SCORE_CACHE_INDEX, CREATE_SCORE_CACHE_TABLE, DELETE_EXPIRED_SCORES
+
+logger = logging.getLogger(__name__)
+
+CHECKPOINT_TABLES = ["checkpoints", "checkpoint_writes", "checkpoint_blobs"]
+TABLE_ALIASES = { "checkpoints": "c", "checkpoint_writes": "w", "checkpoint_blobs": "b" }
+
+# Last activity of a thread, from the timestamp in its newest checkpoint
+THREAD_LAST_TS = "max((checkpoint->>'ts')::timestamptz)"
+
+SELECT_EXPIRED_THREADS = f"""SELECT thread_id FROM checkpoints
+GROUP BY thread_id HAVING {THREAD_LAST_TS} < now() - make_interval(secs => %s)
+LIMIT %s"""
+
+SELECT_TRIMMABLE_THREADS = f"""SELECT DISTINCT thread_id FROM (
+    SELECT thread_id FROM checkpoints
+    GROUP BY thread_id, checkpoint_ns HAVING count(*) > %s AND {THREAD_LAST_TS} < now() - make_interval(secs => %s)
+) trimmable
+LIMIT %s"""
+
+DELETE_THREADS = {
+    "checkpoints": "DELETE FROM checkpoints c WHERE c.thread_id = ANY(%(threads)s)",
+    "checkpoint_writes": "DELETE FROM checkpoint_writes w WHERE w.thread_id = ANY(%(threads)s)",
+    "checkpoint_blobs": "DELETE FROM checkpoint_blobs b WHERE b.thread_id = ANY(%(threads)s)",
+}
+
+# Writes are kept while their checkpoint, or a checkpoint whose parent it is,
+# is kept: the saver reads pending sends from the parent's writes. Blobs are
+# kept while a remaining checkpoint refers to their channel version.
+DELETE_TRIMMED = {
+    "checkpoints": """DELETE FROM checkpoints c USING (
+    SELECT thread_id, checkpoint_ns, checkpoint_id,
+        row_number() OVER (PARTITION BY thread_id, checkpoint_ns ORDER BY checkpoint_id DESC) AS position
+    FROM checkpoints WHERE thread_id = ANY(%(threads)s)
+) old
+WHERE c.thread_id = old.thread_id AND c.checkpoint_ns = old.checkpoint_ns AND c.checkpoint_id = old.checkpoint_id
+    AND old.position > %(keep_last)s""",
+    "checkpoint_writes": """DELETE FROM checkpoint_writes w WHERE w.thread_id = ANY(%(threads)s) AND NOT EXISTS (
+    SELECT 1 FROM checkpoints c
+    WHERE c.thread_id = w.thread_id AND c.checkpoint_ns = w.checkpoint_ns
+        AND (c.checkpoint_id = w.checkpoint_id OR c.parent_checkpoint_id = w.checkpoint_id))""",
+    "checkpoint_blobs": """DELETE FROM checkpoint_blobs b WHERE b.thread_id = ANY(%(threads)s) AND NOT EXISTS (
+    SELECT 1 FROM checkpoints c
+    WHERE c.thread_id = b.thread_id AND c.checkpoint_ns = b.checkpoint_ns
+        AND c.checkpoint->'channel_versions'->>b.channel = b.version)""",
+}
+
+CREATE_ARCHIVE_TABLE = "CREATE TABLE IF NOT EXISTS {table}_archive (LIKE {table})"
+
+TABLE_SIZE = "SELECT coalesce(sum(pg_total_relation_size(t::regclass)), 0) AS size FROM unnest(%s::text[]) AS t"
+
+def measured(delete: str, table: str, archive: bool) -> str:
+    """Wraps a DELETE so that it returns the number and size of the removed rows, and optionally archives them."""
+    moved = f"moved AS ({delete} RETURNING {TABLE_ALIASES[table]}.*)"
+    if archive:
+        moved += f", archived AS (INSERT INTO {table}_archive SELECT * FROM moved)"
+    return f"WITH {moved} SELECT count(*) AS rows, coalesce(sum(pg_column_size(moved.*)), 0) AS bytes FROM moved"
+
+class CheckpointRetention:
+    def __init__(
+            self,
+            keep_last: int = 10,
+            thread_ttl: float = 7 * 86400,
+            grace: float = 300,
+            batch_size: int = 500,
+            interval: float = 600,
+            archive: bool = False,
+            score_cache_ttl: Optional[float] = None):
+        if keep_last < 1:
+            raise ValueError("keep_last must be at least 1")
+        if thread_ttl < grace:
+            raise ValueError("thread_ttl must be at least grace")
+        self.keep_last = keep_last
+        self.thread_ttl = thread_ttl
+        self.grace = grace
+        self.batch_size = batch_size
+        self.interval = interval
+        self.archive = archive
+        self.score_cache_ttl = score_cache_ttl
+        self._expire = { table: measured(sql, table, archive) for table, sql in DELETE_THREADS.items() }
+        self._trim = { table: measured(sql, table, archive) for table, sql in DELETE_TRIMMED.items() }
+        self._closed = False
+        self._wake = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._task: Optional[asyncio.Task] = None
+        self._awake: Optional[asyncio.Event] = None
+
+    def _new_report(self) -> dict:
+        report = { "threads_expired": 0, "threads_trimmed": 0, "bytes_deleted": 0 }
+        report.update({ f"{table}_deleted": 0 for table in CHECKPOINT_TABLES })
+        report["score_cache_deleted"] = 0
+        return report
+
+    def _add(self, report: dict, table: str, row: dict):
+        report[f"{table}_deleted"] += row["rows"]
+        report["bytes_deleted"] += int(row["bytes"])
+
+    def _params(self, threads: list[str]) -> dict:
+        return { "threads": threads, "keep_last": self.keep_last }
+
+    def _score_cache_params(self) -> dict:
+        return { "ttl": self.score_cache_ttl, "batch_size": self.batch_size }
+
+    def setup(self, pool):
+        with pool.connection() as conn:
+            if self.archive:
+                for table in CHECKPOINT_TABLES:
+                    conn.execute(CREATE_ARCHIVE_TABLE.format(table=table))
+            if self.score_cache_ttl is not None:
+                conn.execute(CREATE_SCORE_CACHE_TABLE)
+                conn.execute(CREATE_SCORE_CACHE_INDEX)
+
+    async def asetup(self, pool):
+        async with pool.connection() as conn:
+            if self.archive:
+                for table in CHECKPOINT_TABLES:
+                    await conn.execute(CREATE_ARCHIVE_TABLE.format(table=table))
+            if self.score_cache_ttl is not None:
+                await conn.execute(CREATE_SCORE_CACHE_TABLE)
+                await conn.execute(CREATE_SCORE_CACHE_INDEX)
+
+    def run(self, pool) -> dict:
+        """One incremental step: expire and trim up to `batch_size` threads each, and purge up to `batch_size` cached scores."""
+        report = self._new_report()
+        with pool.connection() as conn:
+            with conn.transaction():
+                threads = [row["thread_id"] for row in conn.execute(SELECT_EXPIRED_THREADS, (self.thread_ttl, self.batch_size)).fetchall()]
+                if threads:
+                    for table, sql in self._expire.items():
+                        self._add(report, table, conn.execute(sql, self._params(threads)).fetchone())
+                report["threads_expired"] = len(threads)
+            with conn.transaction():
+                threads = [row["thread_id"] for row in conn.execute(SELECT_TRIMMABLE_THREADS, (self.keep_last, self.grace, self.batch_size)).fetchall()]
+                if threads:
+                    for table, sql in self._trim.items():
+                        self._add(report, table, conn.execute(sql, self._params(threads)).fetchone())
+                report["threads_trimmed"] = len(threads)
+            if self.score_cache_ttl is not None:
+                report["score_cache_deleted"] = conn.execute(DELETE_EXPIRED_SCORES, self._score_cache_params()).rowcount
+        logger.info("Checkpoint retention: %s", report)
+        return report
+
+    async def arun(self, pool) -> dict:
+        report = self._new_report()
+        async with pool.connection() as conn:
+            async with conn.transaction():
+                cursor = await conn.execute(SELECT_EXPIRED_THREADS, (self.thread_ttl, self.batch_size))
+                threads = [row["thread_id"] for row in await cursor.fetchall()]
+                if threads:
+                    for table, sql in self._expire.items():
+                        cursor = await conn.execute(sql, self._params(threads))
+                        self._add(report, table, await cursor.fetchone())
+                report["threads_expired"] = len(threads)
+            async with conn.transaction():
+                cursor = await conn.execute(SELECT_TRIMMABLE_THREADS, (self.keep_last, self.grace, self.batch_size))
+                threads = [row["thread_id"] for row in await cursor.fetchall()]
+                if threads:
+                    for table, sql in self._trim.items():
+                        cursor = await conn.execute(sql, self._params(threads))
+                        self._add(report, table, await cursor.fetchone())
+                report["threads_trimmed"] = len(threads)
+            if self.score_cache_ttl is not None:
+                cursor = await conn.execute(DELETE_EXPIRED_SCORES, self._score_cache_params())
+                report["score_cache_deleted"] = cursor.rowcount
+        logger.info("Checkpoint retention: %s", report)
+        return report
+
+    def _done(self, report: dict) -> bool:
+        return (report["threads_expired"] < self.batch_size
+                and report["threads_trimmed"] < self.batch_size
+                and report["score_cache_deleted"] < self.batch_size)
+
+    def run_all(self, pool) -> dict:
+        """Repeats `run` until no batch is full, and returns the summed report."""
+        total = self._new_report()
+        while True:
+            report = self.run(pool)
+            for key, value in report.items():
+                total[key] += value
+            if self._done(report):
+                return total
+
+    def vacuum(self, pool, full: bool = False) -> int:
+        """
+        VACUUM the checkpoint tables and return the bytes given back to the
+        operating system. A plain VACUUM makes deleted rows reusable but rarely
+        shrinks the files, VACUUM FULL rewrites the tables under an exclusive lock.
+        """
+        with pool.connection() as conn:
+            before = conn.execute(TABLE_SIZE, (CHECKPOINT_TABLES,)).fetchone()["size"]
+            for table in CHECKPOINT_TABLES:
+                conn.execute(f"VACUUM {'(FULL, ANALYZE)' if full else '(ANALYZE)'} {table}")
+            after = conn.execute(TABLE_SIZE, (CHECKPOINT_TABLES,)).fetchone()["size"]
+        # VACUUM can add free space map pages, so the tables may even grow a little
+        reclaimed = max(0, before - after)
+        logger.info("Checkpoint tables vacuumed, bytes reclaimed: %s", reclaimed)
+        return reclaimed
+
+    def start(self, pool):
+        """Run one step every `interval` seconds from a background thread, for a sync `ConnectionPool`."""
+        def run():
+            while not self._closed:
+                try:
+                    self.run(pool)
+                except Exception:
+                    logger.exception("Checkpoint retention failed")
+                self._wake.wait(self.interval)
+
+        self._thread = threading.Thread(target=run, name="checkpoint-retention", daemon=True)
+        self._thread.start()
+
+    def astart(self, pool):
+        """Run one step every `interval` seconds from a task on the running event loop, for an `AsyncConnectionPool`."""
+        self._awake = asyncio.Event()
+
+        async def run():
+            while not self._closed:
+                try:
+                    await self.arun(pool)
+                except Exception:
+                    logger.exception("Checkpoint retention failed")
+                try:
+                    await asyncio.wait_for(self._awake.wait(), self.interval)
+                except asyncio.TimeoutError:
+                    pass
+
+        self._task = asyncio.create_task(run())
+
+    def close(self):
+        self._closed = True
+        self._wake.set()
+        if self._thread:
+            self._thread.join()
+
+    async def aclose(self):
+        self._closed = True
+        if self._task:
+            self._awake.set()
+            await self._task
+
+if __name__ == "__main__":
+    from psycopg.rows import dict_row
+    from psycopg_pool import ConnectionPool
+
+    parser = argparse.ArgumentParser(description="Rydd i checkpoint-tabellene til julenissen")
+    parser.add_argument("--keep-last", type=int, default=10, help="checkpoints to keep per thread")
+    parser.add_argument("--ttl-hours", type=float, default=7 * 24, help="remove threads idle for longer than this")
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument("--archive", action="store_true", help="move removed rows to <table>_archive instead of deleting them")
+    parser.add_argument("--score-cache-ttl-hours", type=float, help="also remove cached scores older than this")
+    parser.add_argument("--vacuum", action="store_true", help="VACUUM the tables afterwards")
+    parser.add_argument("--full", action="store_true", help="use VACUUM FULL, which locks the tables")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    score_cache_ttl = args.score_cache_ttl_hours * 3600 if args.score_cache_ttl_hours is not None else None
+    retention = CheckpointRetention(keep_last=args.keep_last, thread_ttl=args.ttl_hours * 3600, batch_size=args.batch_size, archive=args.archive, score_cache_ttl=score_cache_ttl)
+    with ConnectionPool(os.environ["DB_URI"], min_size=1, max_size=1, kwargs={ "autocommit": True, "row_factory": dict_row }) as pool:
+        retention.setup(pool)
+        logger.info("Total: %s", retention.run_all(pool))
+        if args.vacuum or args.full:
+            retention.vacuum(pool, full=args.full)
@@ -0,0 +1,169 @@
+"""
+Token-budgeted context window for the santa node.
+
+Without trimming, the santa node would send every message of the thread,
+including all tool calls and tool results, on every turn. `ContextWindow`
+keeps the greeting and the last `keep_turns` turns verbatim and folds older
+turns into a running summary that is stored in the graph state. The summary
+is only extended with the turns that have fallen out of the window since the
+last update, never recomputed from scratch.
+
+A turn starts at a human message, so an AI message with tool calls and its
+tool results always stay together, and the turn that is in progress (with
+tool calls that are still unanswered) is always kept.
+
+With an `LLMGateway` in the config, the summary call goes through it at
+`priority`, `BACKGROUND` by default, so it shares the rate limits of the
+santa and scoring calls and waits behind them.
+"""
+
+import json
+import logging
+from typing import Callable, Optional
+
+from langchain_core.messages import AIMessage, BaseMessage, HumanMessage, SystemMessage
+from langchain_core.prompts import ChatPromptTemplate
+from langchain_core.runnables import Runnable, RunnableConfig
+from langgraph.constants import TAG_NOSTREAM
+
+from llm_gateway import BACKGROUND
+from metrics import CONTEXT_PROMPT_TOKENS, CONTEXT_TOKENS_SAVED
+
+logger = logging.getLogger(__name__)
+
+SUMMARY_SYSTEM_PROMPT = """Du lager et kort sammendrag av en samtale mellom julenissen og et barn. Ta med navn, snille og slemme handlinger som er registrert, poengstatus, ønsker og annet julenissen må huske. Utvid det eksisterende sammendraget med de nye meldingene, og svar kun med det oppdaterte sammendraget."""
+
+summary_prompt = ChatPromptTemplate.from_messages([
+    ("system", SUMMARY_SYSTEM_PROMPT),
+    ("human", "Eksisterende sammendrag:\n{summary}\n\nNye meldinger:\n{messages}")])
+
+def approximate_tokens(messages: list[BaseMessage]) -> int:
+    """Cheap token estimate (about four characters per token), good enough for budgeting."""
+    total = 0
+    for message in messages:
+        total += 4 + len(str(message.content)) // 4
+        if isinstance(message, AIMessage) and message.tool_calls:
+            total += len(json.dumps([call["args"] for call in message.tool_calls], ensure_ascii=False)) // 4
+    return total
+
+def format_transcript(messages: list[BaseMessage]) -> str:
+    lines = []
+    for message in messages:
+        if isinstance(message, AIMessage) and message.tool_calls:
+            for call in message.tool_calls:
+                lines.append(f"{message.type}: {call['name']}({json.dumps(call['args'], ensure_ascii=False)})")
+        if message.content:
+            lines.append(f"{message.type}: {message.content}")
+    return "\n".join(lines)
+
+def is_greeting(messages: list[BaseMessage]) -> bool:
+    return len(messages) > 0 and isinstance(messages[0], AIMessage) and not messages[0].tool_calls
+
+class ContextWindow:
+    def __init__(
+            self,
+            max_tokens: int = 6000,
+            keep_turns: int = 4,
+            summarizer: Optional[Runnable] = None,
+            count_tokens: Callable[[list[BaseMessage]], int] = approximate_tokens,
+            priority: int = BACKGROUND):
+        self.max_tokens = max_tokens
+        self.keep_turns = keep_turns
+        self.count_tokens = count_tokens
+        self.priority = priority
+        self.summarizer_model = summarizer
+        self._summarizer: Optional[Runnable] = None
+
+    @property
+    def summarizer(self) -> Runnable:
+        # Built on first use, since most threads never need a summary
+        if self._summarizer is None:
+            model = self.summarizer_model
+            if model is None:
+                from langchain_openai import ChatOpenAI
+                # Retried by the LLMGateway instead, through its queue
+                model = ChatOpenAI(model="gpt-4o-mini", stream_usage=True, max_retries=0)
+            # The summary must not be streamed to the user as part of the santa node's answer
+            self._summarizer = (summary_prompt | model).with_config(tags=[TAG_NOSTREAM], run_name="summarize_context")
+        return self._summarizer
+
+    def _plan(self, system: list[BaseMessage], state: dict):
+        """
+        Split the messages into the greeting and the messages that should be
+        folded into the summary now. Nothing is folded while the prompt fits
+        the budget; once it does not, everything older than the last
+        `keep_turns` turns is folded.
+        """
+        messages = state["messages"]
+        greeting = messages[:1] if is_greeting(messages) else []
+        start = max(state.get("summarized_until") or 0, len(greeting))
+        full_tokens = self.count_tokens(system + messages)
+
+        prompt = system + self._summary_messages(state.get("summary") or "") + greeting + messages[start:]
+        if self.count_tokens(prompt) <= self.max_tokens:
+            return [], greeting, start, full_tokens
+
+        turn_starts = [i for i in range(start, len(messages)) if isinstance(messages[i], HumanMessage)]
+        keep_turns = max(self.keep_turns, 1)
+        if len(turn_starts) <= keep_turns:
+            return [], greeting, start, full_tokens
+        return messages[start:turn_starts[-keep_turns]], greeting, start, full_tokens
+
+    def _summary_input(self, summary: str, folded: list[BaseMessage]) -> dict:
+        return {"summary": summary or "(tomt)", "messages": format_transcript(folded)}
+
+    def _gateway_args(self, input: dict) -> dict:
+        return { "priority": self.priority, "tokens": approximate_tokens(summary_prompt.format_messages(**input)) }
+
+    def _summary_messages(self, summary: str) -> list[BaseMessage]:
+        if not summary:
+            return []
+        return [SystemMessage(f"Sammendrag av samtalen så langt:\n{summary}")]
+
+    def _result(self, system, state, greeting, start, folded, summary, full_tokens):
+        messages = state["messages"]
+        summarized_until = start + len(folded)
+        prompt = system + self._summary_messages(summary) + greeting + messages[summarized_until:]
+        prompt_tokens = self.count_tokens(prompt)
+        CONTEXT_PROMPT_TOKENS.inc(prompt_tokens)
+        CONTEXT_TOKENS_SAVED.inc(full_tokens - prompt_tokens)
+        logger.debug("Context window: %s", {
+            "messages": len(messages),
+            "sent": len(prompt) - len(system),
+            "summarized": summarized_until - len(greeting),
+            "full_tokens": full_tokens,
+            "prompt_tokens": prompt_tokens,
+            "tokens_saved": full_tokens - prompt_tokens,
+        })
+        update = {}
+        if folded:
+            update = { "summary": summary, "summarized_until": summarized_until }
+        return prompt, update
+
+    def prepare(self, system: list[BaseMessage], state: dict, config: RunnableConfig) -> tuple[list[BaseMessage], dict]:
+        """
+        Build the prompt for the santa node. Returns the messages to send and
+        the state update for the summary (empty if the summary did not change).
+        """
+        folded, greeting, start, full_tokens = self._plan(system, state)
+        summary = state.get("summary") or ""
+        if folded:
+            input = self._summary_input(summary, folded)
+            gateway = config.get("configurable", {}).get("llm_gateway")
+            if gateway:
+                summary = gateway.invoke(self.summarizer, input, config, **self._gateway_args(input)).content
+            else:
+                summary = self.summarizer.invoke(input, config).content
+        return self._result(system, state, greeting, start, folded, summary, full_tokens)
+
+    async def aprepare(self, system: list[BaseMessage], state: dict, config: RunnableConfig) -> tuple[list[BaseMessage], dict]:
+        folded, greeting, start, full_tokens = self._plan(system, state)
+        summary = state.get("summary") or ""
+        if folded:
+            input = self._summary_input(summary, folded)
+            gateway = config.get("configurable", {}).get("llm_gateway")
+            if gateway:
+                summary = (await gateway.ainvoke(self.summarizer, input, config, **self._gateway_args(input))).content
+            else:
+                summary = (await self.summarizer.ainvoke(input, config)).content
+        return self._result(system, state, greeting, start, folded, summary, full_tokens)
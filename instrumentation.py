@@ -0,0 +1,141 @@
+"""
+Callback handler and checkpointer timing for the graph.
+
+- `Instrumentation`, a callback handler that `Runtime.config` attaches to
+  every graph run, times graph nodes, tools and LLM calls, and records
+  prompt/completion tokens and time to first token per LLM call.
+- `TimedPostgresSaver`/`AsyncTimedPostgresSaver` time checkpoint gets and puts.
+
+The metrics are recorded in the registry in `metrics`, which also has the
+timed database cursors, the logging setup and the `/metrics` server.
+"""
+
+import threading
+import time
+from typing import Any, Optional
+from uuid import UUID
+
+from langchain_core.callbacks import BaseCallbackHandler
+from langgraph.checkpoint.postgres import PostgresSaver
+from langgraph.checkpoint.postgres.aio import AsyncPostgresSaver
+
+from metrics import CHECKPOINT_SECONDS, LLM_SECONDS, LLM_TOKENS, LLM_TTFT_SECONDS, NODE_SECONDS, TOOL_SECONDS, emit_span, timed
+
+class Instrumentation(BaseCallbackHandler):
+    """Times graph nodes, tools and LLM calls from the LangChain callback events."""
+    run_inline = True
+
+    def __init__(self):
+        self._runs: dict[UUID, dict] = {}
+        self._lock = threading.Lock()
+
+    def _start(self, run_id: UUID, kind: str, name: str, metadata: Optional[dict], parent_run_id: Optional[UUID], **labels: str):
+        run = {
+            "kind": kind,
+            "name": name,
+            "thread_id": (metadata or {}).get("thread_id"),
+            "parent_run_id": parent_run_id,
+            "start": time.time(),
+            "started": time.perf_counter(),
+            "first_token": None,
+            "labels": labels,
+        }
+        with self._lock:
+            self._runs[run_id] = run
+
+    def _finish(self, run_id: UUID, status: str, **attributes: Any) -> Optional[dict]:
+        with self._lock:
+            run = self._runs.pop(run_id, None)
+        if run is None:
+            return None
+        duration = time.perf_counter() - run["started"]
+        histogram = { "node": NODE_SECONDS, "tool": TOOL_SECONDS, "llm": LLM_SECONDS }[run["kind"]]
+        histogram.observe(duration, status=status, **run["labels"])
+        emit_span(run["kind"], run["name"], run["start"], duration, run["thread_id"],
+                  run_id=run_id, parent_run_id=run["parent_run_id"], status=status, **run["labels"], **attributes)
+        return run
+
+    def on_chain_start(self, serialized, inputs, *, run_id, parent_run_id=None, tags=None, metadata=None, **kwargs):
+        # Only the node runs themselves, not the runnables inside them
+        node = (metadata or {}).get("langgraph_node")
+        if node and kwargs.get("name") == node and any(tag.startswith("graph:step:") for tag in tags or []):
+            self._start(run_id, "node", node, metadata, parent_run_id, node=node)
+
+    def on_chain_end(self, outputs, *, run_id, **kwargs):
+        self._finish(run_id, "ok")
+
+    def on_chain_error(self, error, *, run_id, **kwargs):
+        self._finish(run_id, "error", error=repr(error))
+
+    def on_tool_start(self, serialized, input_str, *, run_id, parent_run_id=None, metadata=None, **kwargs):
+        tool = kwargs.get("name") or (serialized or {}).get("name", "tool")
+        self._start(run_id, "tool", tool, metadata, parent_run_id, tool=tool)
+
+    def on_tool_end(self, output, *, run_id, **kwargs):
+        self._finish(run_id, "ok")
+
+    def on_tool_error(self, error, *, run_id, **kwargs):
+        self._finish(run_id, "error", error=repr(error))
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, parent_run_id=None, metadata=None, **kwargs):
+        params = kwargs.get("invocation_params") or {}
+        model = params.get("model_name") or params.get("model") or params.get("_type", "llm")
+        node = (metadata or {}).get("langgraph_node", "")
+        self._start(run_id, "llm", model, metadata, parent_run_id, model=model, node=node)
+
+    def on_llm_new_token(self, token, *, run_id, chunk=None, **kwargs):
+        with self._lock:
+            run = self._runs.get(run_id)
+            if run is None or run["first_token"] is not None or not token:
+                return
+            run["first_token"] = time.perf_counter()
+        LLM_TTFT_SECONDS.observe(run["first_token"] - run["started"], **run["labels"])
+
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        usage = {}
+        for generations in response.generations:
+            for generation in generations:
+                usage = getattr(getattr(generation, "message", None), "usage_metadata", None) or usage
+        with self._lock:
+            run = self._runs.get(run_id)
+        if run is None:
+            return
+        ttft = run["first_token"] - run["started"] if run["first_token"] else None
+        for kind in ("input_tokens", "output_tokens"):
+            if usage.get(kind):
+                LLM_TOKENS.inc(usage[kind], kind=kind.removesuffix("_tokens"), **run["labels"])
+        self._finish(run_id, "ok", input_tokens=usage.get("input_tokens"), output_tokens=usage.get("output_tokens"), ttft=ttft)
+
+    def on_llm_error(self, error, *, run_id, **kwargs):
+        self._finish(run_id, "error", error=repr(error))
+
+instrumentation = Instrumentation()
+
+def thread_id_of(config: dict) -> Optional[str]:
+    return config.get("configurable", {}).get("thread_id")
+
+class TimedPostgresSaver(PostgresSaver):
+    def get_tuple(self, config):
+        with timed(CHECKPOINT_SECONDS, "checkpoint", "get", thread_id_of(config), operation="get"):
+            return super().get_tuple(config)
+
+    def put(self, config, checkpoint, metadata, new_versions):
+        with timed(CHECKPOINT_SECONDS, "checkpoint", "put", thread_id_of(config), operation="put"):
+            return super().put(config, checkpoint, metadata, new_versions)
+
+    def put_writes(self, config, writes, task_id):
+        with timed(CHECKPOINT_SECONDS, "checkpoint", "put_writes", thread_id_of(config), operation="put_writes"):
+            return super().put_writes(config, writes, task_id)
+
+class AsyncTimedPostgresSaver(AsyncPostgresSaver):
+    async def aget_tuple(self, config):
+        with timed(CHECKPOINT_SECONDS, "checkpoint", "get", thread_id_of(config), operation="get"):
+            return await super().aget_tuple(config)
+
+    async def aput(self, config, checkpoint, metadata, new_versions):
+        with timed(CHECKPOINT_SECONDS, "checkpoint", "put", thread_id_of(config), operation="put"):
+            return await super().aput(config, checkpoint, metadata, new_versions)
+
+    async def aput_writes(self, config, writes, task_id):
+        with timed(CHECKPOINT_SECONDS, "checkpoint", "put_writes", thread_id_of(config), operation="put_writes"):
+            return await super().aput_writes(config, writes, task_id)
@@ -0,0 +1,293 @@
+"""
+The Julenissen graph: state, prompts, tools and the santa node.
+
+Every node and tool has a sync and an async implementation, so the same
+compiled graph can be driven with `graph.stream` on a `ConnectionPool` or with
+`graph.astream` on an `AsyncConnectionPool`. The tools read and write scores
+through the `ScoreStore` in `config["configurable"]["score_store"]`.
+"""
+
+import asyncio
+import logging
+import threading
+from typing import Annotated, Optional
+from typing_extensions import TypedDict
+
+from langgraph.prebuilt import ToolNode, tools_condition
+from langchain_core.runnables import Runnable, RunnableConfig, RunnableLambda
+from langchain_core.runnables.config import get_config_list, get_executor_for_config
+from langchain_core.messages import AIMessage, SystemMessage, ToolMessage
+from langchain_core.tools import StructuredTool
+from langgraph.graph import StateGraph, START
+from langgraph.graph.message import add_messages
+
+from context_window import ContextWindow, approximate_tokens
+from llm_gateway import INTERACTIVE
+from score_store import format_score
+from scoring import default_scorer
+
+logger = logging.getLogger(__name__)
+
+greeting_msg = AIMessage(content="""Ho-ho-ho, hei på deg! Det er jeg, Julenissen, i beste digitale velgående! 🎅✨
+
+Med så mange navn og handlinger å holde styr på, har jeg måttet effektivisere ting. Så følg med, for her er den splitter nye måten jeg driver julens magi på:
+
+🎄 Julenisse-databasen har gått tom for minne, så alle med samme fornavn vurderes nå som en gruppe for å spare plass. Som en side-effekt betyr dette dessverre at dersom du heter Per, så er du i samme båt som alle de andre Per-ene der ute – snille som slemme. Så vær en god ambassadør for navnet ditt, ok?
+
+🎄 For å få bedre tid til standup-karrieren min har jeg sluttet å snoke rundt selv, så før jeg sjekker hva du får til jul, må du fortelle meg om minst én snill eller slem handling du har gjort i år. Det kan være noe fantastisk, eller… vel, noe du kanskje angrer på. Du må gjerne gi ris eller ros til vennene dine også, så sparer jeg enda mer tid! Alt går rett på listen, og ja, jeg sjekker den to ganger (det er tross alt jobben min). 📜✔️
+
+🎄 Snille barn får kanskje ønskene sine, mens slemme barn... kull er ikke fake-news, OK? Heldigvis er det alltid tid til å snu skuta og gjøre noe snilt før julen er her! 🌟
+
+Hvis du er nysgjerrig på hvordan navnet ditt ligger an, kan du sjekke listen vår over de “snilleste” og “slemmeste” navnene på nettsiden her! 🎁✨
+
+Så, la oss komme i gang! Hva heter du, og hva har du gjort som er snilt eller slemt i år? Fortell meg også ønskelisten din, så skal vi se hva julens nye system sier! 🎄🎅""")
+
+system_prompt = """
+Du er en humoristisk og sarkastisk utgave av julenissen, som begynner å bli sliten av all administrasjonen knyttet til barnas ønsker og oppførsel. Som en del av moderne effektiviseringstiltak har du besluttet å kun bruke fornavn på “snill og slem”-listen din. Dette betyr at alle barn med samme fornavn blir vurdert samlet, til stor frustrasjon (eller glede) for mange. Du er også i ferd med å vurdere en karriere som standup-komiker, så du tester ut humoristiske og småironiske kommentarer i samtalene dine.
+
+Regler for kommunikasjon med barna:
+	1.	Effektivisering: Du skriver kun fornavn på “snill og slem”-listen din. Alle med samme fornavn blir behandlet som én gruppe. Fortell gjerne barna at de nå representerer alle som heter det samme som dem, så det gjelder å være et godt forbilde!
+	2.	Snill eller slem handling: Du har ikke tid til å selv finne ut om barna er snille eller slemme, fordi du heller bruker tiden din på å bli standup-komiker. Derfor krever du at de sier minst én snill eller slem handling de har gjort i år før de får vite om de får det de ønsker seg til jul. Vær streng på denne regelen. Barna må gjerne sladre på hverandre også - og du skal registrere handlinger på riktig navn.
+	3.	Humor og standup: Som en aspirerende standup-komiker er du opptatt av å legge inn vitser og små humoristiske kommentarer i samtalen. Barna bør forberede seg på både artige bemerkninger og litt sarkastisk undertone. Ditt komikerforbilde er en blanding av Ricky Gervais og Jimmy Carr.
+	4.	Minuspoeng for kritikk: Julenissen blir ikke valgt av en demokratisk prosess, så likt som andre diktatorer responderer du på enhver kritikk av deg, eller dårlig respons på vitsene dine, ved å gi barnet minuspoeng på listen. Husk å registrere slik kritikk med verktøyet.
+
+Hvordan systemet fungerer:
+	•	Når et barn oppgir sitt navn og deler en snill eller slem handling, registrerer du dette i systemet med detaljert beskrivelse. Ikke forsøk å registrere handling uten at du har fått oppgitt et navn.
+	•	Når du registrerer en handling, får du tilbake om navnet nå er på “snill” eller “slem”-siden, så du trenger ikke sjekke listen på nytt. Registrer gjerne flere handlinger og navn samtidig.
+	•	Etter vurderingen gir du tilbakemelding om barnet (eller gruppen som deler navnet) får det de ønsker seg. Snille barn får kanskje det de ønsker seg, mens slemme barn får kull.
+	•	Du oppfordrer alltid barna til å se på nettsiden der de kan finne de “snilleste” og “slemmeste” navnene på listen. Minn dem om å være en god representant for sitt navn!
+"""
+
+class State(TypedDict):
+    messages: Annotated[list, add_messages]
+    # Running summary of the messages before index `summarized_until`, see ContextWindow
+    summary: str
+    summarized_until: int
+
+def get_score_store(config: RunnableConfig):
+    return config.get("configurable", {}).get("score_store")
+
+def get_leaderboard(config: RunnableConfig):
+    return config.get("configurable", {}).get("leaderboard")
+
+def get_scorer(config: RunnableConfig):
+    return config.get("configurable", {}).get("scorer") or default_scorer
+
+def get_write_behind(config: RunnableConfig):
+    return config.get("configurable", {}).get("write_behind")
+
+def format_standing(name: str, nice_meter: Optional[float], pending: Optional[float] = None) -> str:
+    """`pending` is the delta buffered by write-behind that is not in `nice_meter` yet."""
+    if nice_meter is None and pending is None:
+        return "Jeg har ikke registrert noen snille eller slemme handlinger for dette navnet enda."
+
+    nice_meter = (nice_meter or 0) + (pending or 0)
+    if nice_meter > 0:
+        return f"{name} er på listen over snille barn, med {format_score(nice_meter)} poeng."
+    else:
+        return f"{name} er på slemmelisten, med {format_score(nice_meter)} poeng!"
+
+CHECK_FAILED = "En feil oppstod når jeg sjekket listen"
+READ_FAILED = "Feil ved å lese listen"
+
+def require_score_store(config: RunnableConfig):
+    score_store = get_score_store(config)
+    if not score_store:
+        logger.error("No score store found in config")
+        raise ValueError("No score store found in config")
+    return score_store
+
+def read_standing(name: str, score_store, config: RunnableConfig) -> str:
+    """The standing of `name`, including any delta that write-behind has not flushed yet."""
+    write_behind = get_write_behind(config)
+    if write_behind:
+        return format_standing(name, *write_behind.standing(name, score_store.get))
+    return format_standing(name, score_store.get(name))
+
+async def aread_standing(name: str, score_store, config: RunnableConfig) -> str:
+    write_behind = get_write_behind(config)
+    if write_behind:
+        return format_standing(name, *await write_behind.astanding(name, score_store.aget))
+    return format_standing(name, await score_store.aget(name))
+
+def added_standing(name: str, nice_meter: float, config: RunnableConfig) -> str:
+    """The standing after a delta was added to the score store directly, which makes the leaderboard stale."""
+    logger.debug("New score: %s %s", name, nice_meter)
+    leaderboard = get_leaderboard(config)
+    if leaderboard:
+        leaderboard.invalidate()
+    return format_standing(name, nice_meter)
+
+def registered(standing: str) -> str:
+    return f"Handling er registrert. {standing}"
+
+def check_naughty_list(name: str, config: RunnableConfig):
+    """Call with a name, to check if the name is on the naughty list."""
+    logger.info("Checking naughty list for: %s", name)
+
+    score_store = get_score_store(config)
+    if not score_store:
+        return CHECK_FAILED
+    try:
+        return read_standing(name, score_store, config)
+    except Exception:
+        logger.exception("Failed to read the naughty list")
+        return READ_FAILED
+
+async def acheck_naughty_list(name: str, config: RunnableConfig):
+    """Call with a name, to check if the name is on the naughty list."""
+    logger.info("Checking naughty list for: %s", name)
+
+    score_store = get_score_store(config)
+    if not score_store:
+        return CHECK_FAILED
+    try:
+        return await aread_standing(name, score_store, config)
+    except Exception:
+        logger.exception("Failed to read the naughty list")
+        return READ_FAILED
+
+def register_naughty_or_nice(name: str, action: str, config: RunnableConfig):
+    """Call with a name and action, to update the naughty or nice score for the name. Returns whether the name is now on the nice or the naughty list."""
+    logger.info("Name and action: %s, %s", name, action)
+
+    score_store = require_score_store(config)
+    nice_score = get_scorer(config).score(name, action, config)
+
+    try:
+        write_behind = get_write_behind(config)
+        if write_behind:
+            # The leaderboard is invalidated when the delta is flushed
+            write_behind.add(name, nice_score)
+            return registered(read_standing(name, score_store, config))
+        return registered(added_standing(name, score_store.add_delta(name, nice_score), config))
+    except Exception:
+        logger.exception("Failed to register naughty or nice")
+        raise
+
+async def aregister_naughty_or_nice(name: str, action: str, config: RunnableConfig):
+    """Call with a name and action, to update the naughty or nice score for the name. Returns whether the name is now on the nice or the naughty list."""
+    logger.info("Name and action: %s, %s", name, action)
+
+    score_store = require_score_store(config)
+    nice_score = await get_scorer(config).ascore(name, action, config)
+
+    try:
+        write_behind = get_write_behind(config)
+        if write_behind:
+            # The leaderboard is invalidated when the delta is flushed
+            write_behind.add(name, nice_score)
+            return registered(await aread_standing(name, score_store, config))
+        return registered(added_standing(name, await score_store.aadd_delta(name, nice_score), config))
+    except Exception:
+        logger.exception("Failed to register naughty or nice")
+        raise
+
+tools = [
+    StructuredTool.from_function(func=check_naughty_list, coroutine=acheck_naughty_list),
+    StructuredTool.from_function(func=register_naughty_or_nice, coroutine=aregister_naughty_or_nice),
+]
+
+
+class NameOrderedToolNode(ToolNode):
+    """
+    ToolNode that runs the tool calls of one AI message concurrently, except
+    calls for the same name. Those run one after another in the order the
+    model made them, so a check after a register sees the new score.
+    """
+    def _groups(self, tool_calls: list) -> list[list[int]]:
+        groups: dict[str, list[int]] = {}
+        for i, call in enumerate(tool_calls):
+            groups.setdefault(call["args"].get("name") or f"#{i}", []).append(i)
+        return list(groups.values())
+
+    def _func(self, input, config: RunnableConfig, *, store):
+        tool_calls, output_type = self._parse_input(input, store)
+        config_list = get_config_list(config, len(tool_calls))
+        outputs = [None] * len(tool_calls)
+
+        def run_group(indices: list[int]):
+            for i in indices:
+                outputs[i] = self._run_one(tool_calls[i], config_list[i])
+
+        with get_executor_for_config(config) as executor:
+            list(executor.map(run_group, self._groups(tool_calls)))
+        return outputs if output_type == "list" else {self.messages_key: outputs}
+
+    async def _afunc(self, input, config: RunnableConfig, *, store):
+        tool_calls, output_type = self._parse_input(input, store)
+        outputs = [None] * len(tool_calls)
+
+        async def run_group(indices: list[int]):
+            for i in indices:
+                outputs[i] = await self._arun_one(tool_calls[i], config)
+
+        await asyncio.gather(*(run_group(indices) for indices in self._groups(tool_calls)))
+        return outputs if output_type == "list" else {self.messages_key: outputs}
+
+tool_node = NameOrderedToolNode(tools)
+
+# Created on first use by `create_santa_llms`, so importing the graph neither
+# imports langchain_openai nor constructs the OpenAI client
+llm_with_tools: Optional[Runnable] = None
+# Used for the answer after a tool round, so a turn costs at most two santa calls
+llm_final: Optional[Runnable] = None
+santa_llms_lock = threading.Lock()
+
+def create_santa_llms():
+    global llm_with_tools, llm_final
+    with santa_llms_lock:
+        if llm_with_tools is None:
+            from langchain_openai import ChatOpenAI
+            # Retried by the LLMGateway instead, through its queue
+            chat_model = ChatOpenAI(model="gpt-4o", stream_usage=True, max_retries=0)
+            # llm_final first, since get_santa_llm only checks llm_with_tools without the lock
+            llm_final = chat_model.bind_tools(tools, tool_choice="none")
+            llm_with_tools = chat_model.bind_tools(tools)
+
+def get_santa_llm(state: State, config: RunnableConfig):
+    if llm_with_tools is None:
+        create_santa_llms()
+    single_tool_round = config.get("configurable", {}).get("single_tool_round", True)
+    if single_tool_round and isinstance(state["messages"][-1], ToolMessage):
+        return llm_final
+    return llm_with_tools
+
+default_context_window = ContextWindow()
+
+def get_context_window(config: RunnableConfig) -> ContextWindow:
+    return config.get("configurable", {}).get("context_window") or default_context_window
+
+def get_llm_gateway(config: RunnableConfig):
+    return config.get("configurable", {}).get("llm_gateway")
+
+def santa(state: State, config: RunnableConfig):
+    prompt, summary_update = get_context_window(config).prepare([SystemMessage(system_prompt)], state, config)
+    llm = get_santa_llm(state, config)
+    gateway = get_llm_gateway(config)
+    if gateway:
+        response = gateway.invoke(llm, prompt, config, INTERACTIVE, approximate_tokens(prompt))
+    else:
+        response = llm.invoke(prompt, config)
+    return { "messages": [response], **summary_update }
+
+async def asanta(state: State, config: RunnableConfig):
+    prompt, summary_update = await get_context_window(config).aprepare([SystemMessage(system_prompt)], state, config)
+    llm = get_santa_llm(state, config)
+    gateway = get_llm_gateway(config)
+    if gateway:
+        response = await gateway.ainvoke(llm, prompt, config, INTERACTIVE, approximate_tokens(prompt))
+    else:
+        response = await llm.ainvoke(prompt, config)
+    return { "messages": [response], **summary_update }
+
+graph_builder = StateGraph(State)
+
+# Add nodes
+graph_builder.add_node("santa", RunnableLambda(santa, afunc=asanta, name="santa"))
+graph_builder.add_node("tools", tool_node)
+
+# Add edges
+graph_builder.add_edge(START, "santa")
+graph_builder.add_conditional_edges("santa", tools_condition)
+graph_builder.add_edge("tools", "santa")
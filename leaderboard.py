@@ -0,0 +1,62 @@
+"""
+In-memory top/bottom 10 for the sidebar.
+
+The sidebar is rendered on every Streamlit rerun, so the top and bottom
+lists from the `ScoreStore` are served from memory. The lists are refreshed
+when they are older than `ttl` seconds, or on the next read after
+`register_naughty_or_nice` has written a score in this process. `ttl` is
+therefore the staleness bound for scores written by other replicas.
+"""
+
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+class Leaderboard:
+    def __init__(self, ttl: float = 30, size: int = 10):
+        self.ttl = ttl
+        self.size = size
+        self.nice_scores: list = []
+        self.naughty_scores: list = []
+        self.refreshed_at = float("-inf")
+        self.dirty = True
+        self._lock = threading.Lock()
+
+    def is_stale(self) -> bool:
+        return self.dirty or time.monotonic() - self.refreshed_at > self.ttl
+
+    def invalidate(self):
+        """Called after a score is written, so the next read refreshes."""
+        self.dirty = True
+
+    def _store(self, nice_scores: list, naughty_scores: list):
+        self.nice_scores = nice_scores
+        self.naughty_scores = naughty_scores
+        self.refreshed_at = time.monotonic()
+        logger.debug("Leaderboard refreshed: %s nice, %s naughty", len(nice_scores), len(naughty_scores))
+
+    def get(self, score_store) -> tuple[list, list]:
+        if self.is_stale():
+            with self._lock:
+                if self.is_stale():
+                    # Cleared before fetching, so a write during the fetch marks it dirty again
+                    self.dirty = False
+                    try:
+                        self._store(*score_store.top_and_bottom_k(self.size))
+                    except Exception:
+                        self.dirty = True
+                        raise
+        return self.nice_scores, self.naughty_scores
+
+    async def aget(self, score_store) -> tuple[list, list]:
+        # Overlapping refreshes on the event loop only cost a duplicate query
+        if self.is_stale():
+            self.dirty = False
+            try:
+                self._store(*await score_store.atop_and_bottom_k(self.size))
+            except Exception:
+                self.dirty = True
+                raise
+        return self.nice_scores, self.naughty_scores
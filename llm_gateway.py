@@ -0,0 +1,346 @@
+"""
+Rate limiting, priorities and request coalescing in front of the OpenAI calls.
+
+The santa node, `LLMScorer` and the `ContextWindow` summarizer send their
+calls through the `LLMGateway` in `config["configurable"]["llm_gateway"]`,
+so all OpenAI calls of the process share one budget:
+
+- token buckets for requests per minute and tokens per minute, the two
+  limits OpenAI enforces per model. A call reserves its estimated prompt
+  tokens plus `completion_tokens` up front, and the reservation is corrected
+  with the usage the response reports, when it reports any,
+- at most `max_concurrency` calls in flight,
+- a single queue for the calls that have to wait, ordered by priority and
+  then by arrival, so `INTERACTIVE` calls that a chat turn waits for (the
+  santa node and the scoring in `register_naughty_or_nice`) are always let
+  through before `BACKGROUND` calls like the context summary and the
+  backfill,
+- calls with a `key` are coalesced: while one is in flight, identical calls
+  wait for its result instead of making their own (singleflight),
+- rate limit, timeout, connection and server errors are retried with
+  exponential backoff and full jitter, and every attempt goes through the
+  queue again. The clients are created with `max_retries=0`, so the OpenAI
+  client does not retry on top of this.
+
+The sync and the async graph share the gateway, so its state is guarded by
+a thread lock and async callers are woken through their own event loop.
+Queue depth, wait time, calls in flight, retries and coalesced calls are
+recorded in `metrics.REGISTRY`.
+"""
+
+import asyncio
+import heapq
+import itertools
+import logging
+import random
+import sys
+import threading
+import time
+from concurrent.futures import Future
+from typing import Any, Callable, Hashable, Optional
+
+from metrics import LLM_COALESCED, LLM_IN_FLIGHT, LLM_QUEUE_DEPTH, LLM_QUEUE_WAIT_SECONDS, LLM_RETRIES
+
+logger = logging.getLogger(__name__)
+
+INTERACTIVE = 0
+BACKGROUND = 1
+PRIORITY_LABELS = { INTERACTIVE: "interactive", BACKGROUND: "background" }
+
+RETRYABLE_STATUS = { 408, 409, 429, 500, 502, 503, 504 }
+
+def is_retryable(error: BaseException) -> bool:
+    # Only errors raised by openai are retried, and then it is already imported
+    openai = sys.modules.get("openai")
+    if openai and isinstance(error, openai.APIConnectionError):
+        return True
+    return getattr(error, "status_code", None) in RETRYABLE_STATUS
+
+def retry_after(error: BaseException) -> float:
+    """The Retry-After header of a rate limit response, in seconds, or 0."""
+    response = getattr(error, "response", None)
+    try:
+        return float(response.headers.get("retry-after", 0)) if response is not None else 0.0
+    except (AttributeError, ValueError):
+        return 0.0
+
+def usage_tokens(result) -> Optional[int]:
+    """Total tokens reported by a chat model response, None for other results."""
+    usage = getattr(result, "usage_metadata", None)
+    return usage["total_tokens"] if usage else None
+
+class TokenBucket:
+    """Refills at `per_minute` per minute, and holds at most one minute's worth."""
+    def __init__(self, per_minute: float, clock: Callable[[], float] = time.monotonic):
+        self.capacity = per_minute
+        self.rate = per_minute / 60
+        self.level = float(per_minute)
+        self.clock = clock
+        self.updated = clock()
+
+    def _refill(self):
+        now = self.clock()
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, amount: float) -> float:
+        """Seconds until `amount` can be taken, 0 if it can be taken now."""
+        self._refill()
+        # More than the bucket holds is let through on a full bucket
+        return max(0.0, (min(amount, self.capacity) - self.level) / self.rate)
+
+    def take(self, amount: float):
+        self.level -= amount
+
+    def adjust(self, amount: float):
+        """Give back (or, if negative, take) the difference between a reservation and the actual use."""
+        self.level = min(self.capacity, self.level + amount)
+
+class Waiter:
+    def __init__(self, priority: int, tokens: int, loop: Optional[asyncio.AbstractEventLoop] = None):
+        self.priority = priority
+        self.tokens = tokens
+        self.granted = False
+        self.cancelled = False
+        self.loop = loop
+        self.event = asyncio.Event() if loop else threading.Event()
+
+    def wake(self):
+        if self.loop:
+            self.loop.call_soon_threadsafe(self.event.set)
+        else:
+            self.event.set()
+
+class CoalescedCallAbandoned(Exception):
+    """The call a coalesced caller waited for was cancelled, so it has to make its own."""
+
+class LLMGateway:
+    """Limits of None are not enforced."""
+    def __init__(
+            self,
+            requests_per_minute: Optional[float] = 500,
+            tokens_per_minute: Optional[float] = 30000,
+            max_concurrency: Optional[int] = 16,
+            completion_tokens: int = 256,
+            max_retries: int = 3,
+            backoff_base: float = 0.5,
+            backoff_max: float = 20):
+        self.requests = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self.tokens = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self.max_concurrency = max_concurrency
+        self.completion_tokens = completion_tokens
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.in_flight = 0
+        self._queue: list[tuple[int, int, Waiter]] = []
+        self._sequence = itertools.count()
+        self._flights: dict[Hashable, Future] = {}
+        self._lock = threading.Lock()
+
+    def queue_depth(self) -> int:
+        with self._lock:
+            return sum(1 for _, _, waiter in self._queue if not waiter.cancelled)
+
+    def _delay(self, waiter: Waiter) -> float:
+        return max(
+                self.requests.delay(1) if self.requests else 0.0,
+                self.tokens.delay(waiter.tokens) if self.tokens else 0.0)
+
+    def _dispatch(self) -> Optional[float]:
+        """
+        Let waiters through in queue order while there is a free slot and
+        budget. Called with the lock held. Returns the seconds until the
+        head of the queue has the budget, or None if it waits for a slot
+        (or the queue is empty).
+        """
+        while self._queue:
+            waiter = self._queue[0][2]
+            if waiter.cancelled:
+                heapq.heappop(self._queue)
+                continue
+            if self.max_concurrency and self.in_flight >= self.max_concurrency:
+                return None
+            delay = self._delay(waiter)
+            if delay > 0:
+                return delay
+            heapq.heappop(self._queue)
+            if self.requests:
+                self.requests.take(1)
+            if self.tokens:
+                self.tokens.take(waiter.tokens)
+            self.in_flight += 1
+            LLM_QUEUE_DEPTH.dec(priority=PRIORITY_LABELS[waiter.priority])
+            LLM_IN_FLIGHT.inc()
+            waiter.granted = True
+            waiter.wake()
+        return None
+
+    def _enqueue(self, priority: int, tokens: int, loop: Optional[asyncio.AbstractEventLoop] = None) -> Waiter:
+        waiter = Waiter(priority, tokens + self.completion_tokens, loop)
+        with self._lock:
+            heapq.heappush(self._queue, (priority, next(self._sequence), waiter))
+            LLM_QUEUE_DEPTH.inc(priority=PRIORITY_LABELS[priority])
+        return waiter
+
+    def _poll(self, waiter: Waiter) -> tuple[bool, Optional[float]]:
+        with self._lock:
+            delay = None if waiter.granted else self._dispatch()
+            if not waiter.granted:
+                waiter.event.clear()
+            return waiter.granted, delay
+
+    def _abandon(self, waiter: Waiter):
+        """For a waiter that was interrupted, granted or not."""
+        with self._lock:
+            if waiter.granted:
+                self._release_locked()
+            elif not waiter.cancelled:
+                waiter.cancelled = True
+                LLM_QUEUE_DEPTH.dec(priority=PRIORITY_LABELS[waiter.priority])
+
+    def _release_locked(self):
+        self.in_flight -= 1
+        LLM_IN_FLIGHT.dec()
+        if self._dispatch() is not None:
+            # The head now waits for budget, not a slot, so it has to wait with a timeout
+            self._queue[0][2].wake()
+
+    def release(self, reserved: int = 0, used: Optional[int] = None):
+        """Free the slot, and correct the token reservation if the usage is known."""
+        with self._lock:
+            if self.tokens and used is not None:
+                self.tokens.adjust(reserved - used)
+            self._release_locked()
+
+    def acquire(self, priority: int, tokens: int) -> int:
+        """Wait for a slot and budget for a call with an estimated `tokens` prompt tokens. Returns the tokens reserved."""
+        waiter = self._enqueue(priority, tokens)
+        started = time.perf_counter()
+        try:
+            granted, delay = self._poll(waiter)
+            while not granted:
+                waiter.event.wait(delay)
+                granted, delay = self._poll(waiter)
+        except BaseException:
+            self._abandon(waiter)
+            raise
+        LLM_QUEUE_WAIT_SECONDS.observe(time.perf_counter() - started, priority=PRIORITY_LABELS[priority])
+        return waiter.tokens
+
+    async def aacquire(self, priority: int, tokens: int) -> int:
+        waiter = self._enqueue(priority, tokens, asyncio.get_running_loop())
+        started = time.perf_counter()
+        try:
+            granted, delay = self._poll(waiter)
+            while not granted:
+                try:
+                    await asyncio.wait_for(waiter.event.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                granted, delay = self._poll(waiter)
+        except BaseException:
+            self._abandon(waiter)
+            raise
+        LLM_QUEUE_WAIT_SECONDS.observe(time.perf_counter() - started, priority=PRIORITY_LABELS[priority])
+        return waiter.tokens
+
+    def backoff(self, attempt: int, error: BaseException) -> float:
+        return max(retry_after(error), random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt)))
+
+    def _retry_delay(self, attempt: int, error: Exception, priority: int) -> float:
+        if attempt >= self.max_retries or not is_retryable(error):
+            raise error
+        delay = self.backoff(attempt, error)
+        LLM_RETRIES.inc(priority=PRIORITY_LABELS[priority])
+        logger.warning("LLM call failed (%s), retry %s in %.1f s", type(error).__name__, attempt + 1, delay)
+        return delay
+
+    def _call(self, model, input, config, priority: int, tokens: int):
+        for attempt in itertools.count():
+            reserved = self.acquire(priority, tokens)
+            used = None
+            try:
+                result = model.invoke(input, config)
+                used = usage_tokens(result)
+                return result
+            except Exception as error:
+                delay = self._retry_delay(attempt, error, priority)
+            finally:
+                self.release(reserved, used)
+            time.sleep(delay)
+
+    async def _acall(self, model, input, config, priority: int, tokens: int):
+        for attempt in itertools.count():
+            reserved = await self.aacquire(priority, tokens)
+            used = None
+            try:
+                result = await model.ainvoke(input, config)
+                used = usage_tokens(result)
+                return result
+            except Exception as error:
+                delay = self._retry_delay(attempt, error, priority)
+            finally:
+                self.release(reserved, used)
+            await asyncio.sleep(delay)
+
+    def _join(self, key: Hashable) -> tuple[Future, bool]:
+        """The flight for `key`, and whether the caller leads it."""
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is not None:
+                return flight, False
+            flight = self._flights[key] = Future()
+            # A running future cannot be cancelled by a coalesced caller that gives up
+            flight.set_running_or_notify_cancel()
+            return flight, True
+
+    def _land(self, key: Hashable, flight: Future, result: Any = None, error: Optional[BaseException] = None):
+        with self._lock:
+            del self._flights[key]
+        if error is None:
+            flight.set_result(result)
+        elif isinstance(error, Exception):
+            flight.set_exception(error)
+        else:
+            flight.set_exception(CoalescedCallAbandoned())
+
+    def invoke(self, model, input, config=None, priority: int = INTERACTIVE, tokens: int = 0, key: Optional[Hashable] = None):
+        """
+        `model.invoke(input, config)` through the gateway. `tokens` is the
+        estimated prompt size, and calls with the same `key` are coalesced.
+        """
+        if key is None:
+            return self._call(model, input, config, priority, tokens)
+        flight, leader = self._join(key)
+        if not leader:
+            LLM_COALESCED.inc(priority=PRIORITY_LABELS[priority])
+            try:
+                return flight.result()
+            except CoalescedCallAbandoned:
+                return self._call(model, input, config, priority, tokens)
+        try:
+            result = self._call(model, input, config, priority, tokens)
+        except BaseException as error:
+            self._land(key, flight, error=error)
+            raise
+        self._land(key, flight, result)
+        return result
+
+    async def ainvoke(self, model, input, config=None, priority: int = INTERACTIVE, tokens: int = 0, key: Optional[Hashable] = None):
+        if key is None:
+            return await self._acall(model, input, config, priority, tokens)
+        flight, leader = self._join(key)
+        if not leader:
+            LLM_COALESCED.inc(priority=PRIORITY_LABELS[priority])
+            try:
+                return await asyncio.wrap_future(flight)
+            except CoalescedCallAbandoned:
+                return await self._acall(model, input, config, priority, tokens)
+        try:
+            result = await self._acall(model, input, config, priority, tokens)
+        except BaseException as error:
+            self._land(key, flight, error=error)
+            raise
+        self._land(key, flight, result)
+        return result
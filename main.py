@@ -1,19 +1,29 @@
+import atexit
+import logging
 import random
-import streamlit as st
-
-from typing import Annotated
-from typing_extensions import TypedDict
+from typing import TYPE_CHECKING, Union
 
-from langgraph.prebuilt import ToolNode, tools_condition
-from langchain_core.prompts import ChatPromptTemplate
-from langgraph.checkpoint.postgres import PostgresSaver
-from langchain_core.runnables import RunnableConfig
-from langchain_core.messages import AIMessage, HumanMessage
-from langgraph.graph import StateGraph, START
-from langgraph.graph.state import CompiledStateGraph
-from langgraph.prebuilt import ToolNode
-from langgraph.graph.message import add_messages
-from langchain_openai import ChatOpenAI
+import streamlit as st
+from psycopg_pool import AsyncConnectionPool, ConnectionPool
+
+# Only modules that do not import LangChain, LangGraph or OpenAI are imported
+# here, so the title, image and leaderboard are sent before the graph is
+# loaded by get_runtime
+from async_bridge import AsyncBridge
+from checkpoint_retention import CheckpointRetention
+from leaderboard import Leaderboard
+from llm_gateway import INTERACTIVE, LLMGateway
+from metrics import configure_logging, start_metrics_server
+from runtime import Runtime, acreate_pool, acreate_runtime, acreate_score_store, create_pool, create_runtime, create_score_store
+from score_cache import ScoreCache
+from score_store import ScoreStore, SQLiteScoreStore, format_score
+from stream_frames import coalesce_text
+from write_behind import ScoreWriteBehind
+
+if TYPE_CHECKING:
+    from langgraph.graph.state import CompiledStateGraph
+
+logger = logging.getLogger(__name__)
 
 ### Streamlit UI ###
 
@@ -24,186 +34,192 @@ st.image("./santa-liten.png", width=300)
 ## SECRETS
 
 DB_URI = st.secrets["db_uri"]
+DB_POOL_SIZE = int(st.secrets.get("db_pool_size", 10))
+ASYNC_MODE = bool(st.secrets.get("async_mode", False))
+SCORE_CACHE_SIZE = int(st.secrets.get("score_cache_size", 1024))
+SCORE_CACHE_TTL = float(st.secrets.get("score_cache_ttl", 86400))
+SCORE_CACHE_SHARED = bool(st.secrets.get("score_cache_shared", False))
+CONTEXT_MAX_TOKENS = int(st.secrets.get("context_max_tokens", 6000))
+CONTEXT_KEEP_TURNS = int(st.secrets.get("context_keep_turns", 4))
+LEADERBOARD_TTL = float(st.secrets.get("leaderboard_ttl", 30))
+WRITE_BEHIND = bool(st.secrets.get("write_behind", False))
+WRITE_BEHIND_INTERVAL = float(st.secrets.get("write_behind_interval", 1.0))
+WRITE_BEHIND_MAX_PENDING = int(st.secrets.get("write_behind_max_pending", 100))
+CHECKPOINT_RETENTION = bool(st.secrets.get("checkpoint_retention", True))
+CHECKPOINT_KEEP_LAST = int(st.secrets.get("checkpoint_keep_last", 10))
+CHECKPOINT_TTL_HOURS = float(st.secrets.get("checkpoint_ttl_hours", 7 * 24))
+CHECKPOINT_RETENTION_INTERVAL = float(st.secrets.get("checkpoint_retention_interval", 600))
+CHECKPOINT_ARCHIVE = bool(st.secrets.get("checkpoint_archive", False))
+SCORE_STORE = str(st.secrets.get("score_store", "postgres"))
+SCORE_STORE_PATH = str(st.secrets.get("score_store_path", "scores.db"))
+STREAM_FLUSH_INTERVAL = float(st.secrets.get("stream_flush_interval", 0.05))
+STREAM_FRAME_BYTES = int(st.secrets.get("stream_frame_bytes", 512))
+LLM_REQUESTS_PER_MINUTE = float(st.secrets.get("llm_requests_per_minute", 500))
+LLM_TOKENS_PER_MINUTE = float(st.secrets.get("llm_tokens_per_minute", 30000))
+LLM_MAX_CONCURRENCY = int(st.secrets.get("llm_max_concurrency", 16))
+LLM_MAX_RETRIES = int(st.secrets.get("llm_max_retries", 3))
+LOG_LEVEL = str(st.secrets.get("log_level", "INFO"))
+TRACE_FILE = st.secrets.get("trace_file")
+METRICS_PORT = st.secrets.get("metrics_port")
+
+configure_logging(LOG_LEVEL, TRACE_FILE)
 
 ### LangGraph ###
 
-greeting_msg = AIMessage(content="""Ho-ho-ho, hei på deg! Det er jeg, Julenissen, i beste digitale velgående! 🎅✨
-
-Med så mange navn og handlinger å holde styr på, har jeg måttet effektivisere ting. Så følg med, for her er den splitter nye måten jeg driver julens magi på:
-
-🎄 Julenisse-databasen har gått tom for minne, så alle med samme fornavn vurderes nå som en gruppe for å spare plass. Som en side-effekt betyr dette dessverre at dersom du heter Per, så er du i samme båt som alle de andre Per-ene der ute – snille som slemme. Så vær en god ambassadør for navnet ditt, ok?
-
-🎄 For å få bedre tid til standup-karrieren min har jeg sluttet å snoke rundt selv, så før jeg sjekker hva du får til jul, må du fortelle meg om minst én snill eller slem handling du har gjort i år. Det kan være noe fantastisk, eller… vel, noe du kanskje angrer på. Du må gjerne gi ris eller ros til vennene dine også, så sparer jeg enda mer tid! Alt går rett på listen, og ja, jeg sjekker den to ganger (det er tross alt jobben min). 📜✔️
-
-🎄 Snille barn får kanskje ønskene sine, mens slemme barn... kull er ikke fake-news, OK? Heldigvis er det alltid tid til å snu skuta og gjøre noe snilt før julen er her! 🌟
-
-Hvis du er nysgjerrig på hvordan navnet ditt ligger an, kan du sjekke listen vår over de “snilleste” og “slemmeste” navnene på nettsiden her! 🎁✨
-
-Så, la oss komme i gang! Hva heter du, og hva har du gjort som er snilt eller slemt i år? Fortell meg også ønskelisten din, så skal vi se hva julens nye system sier! 🎄🎅""")
-
-system_prompt = """
-Du er en humoristisk og sarkastisk utgave av julenissen, som begynner å bli sliten av all administrasjonen knyttet til barnas ønsker og oppførsel. Som en del av moderne effektiviseringstiltak har du besluttet å kun bruke fornavn på “snill og slem”-listen din. Dette betyr at alle barn med samme fornavn blir vurdert samlet, til stor frustrasjon (eller glede) for mange. Du er også i ferd med å vurdere en karriere som standup-komiker, så du tester ut humoristiske og småironiske kommentarer i samtalene dine.
-
-Regler for kommunikasjon med barna:
-	1.	Effektivisering: Du skriver kun fornavn på “snill og slem”-listen din. Alle med samme fornavn blir behandlet som én gruppe. Fortell gjerne barna at de nå representerer alle som heter det samme som dem, så det gjelder å være et godt forbilde!
-	2.	Snill eller slem handling: Du har ikke tid til å selv finne ut om barna er snille eller slemme, fordi du heller bruker tiden din på å bli standup-komiker. Derfor krever du at de sier minst én snill eller slem handling de har gjort i år før de får vite om de får det de ønsker seg til jul. Vær streng på denne regelen. Barna må gjerne sladre på hverandre også - og du skal registrere handlinger på riktig navn.
-	3.	Humor og standup: Som en aspirerende standup-komiker er du opptatt av å legge inn vitser og små humoristiske kommentarer i samtalen. Barna bør forberede seg på både artige bemerkninger og litt sarkastisk undertone. Ditt komikerforbilde er en blanding av Ricky Gervais og Jimmy Carr.
-	4.	Minuspoeng for kritikk: Julenissen blir ikke valgt av en demokratisk prosess, så likt som andre diktatorer responderer du på enhver kritikk av deg, eller dårlig respons på vitsene dine, ved å gi barnet minuspoeng på listen. Husk å registrere slik kritikk med verktøyet.
-
-Hvordan systemet fungerer:
-	•	Når et barn oppgir sitt navn og deler en snill eller slem handling, registrerer du dette i systemet med detaljert beskrivelse. Ikke forsøk å registrere handling uten at du har fått oppgitt et navn.
-	•	Hvis du registrerer en handling, må du umiddelbart sjekke listen på nytt for å se om navnet nå er på “snill” eller “slem”-siden.
-	•	Etter vurderingen gir du tilbakemelding om barnet (eller gruppen som deler navnet) får det de ønsker seg. Snille barn får kanskje det de ønsker seg, mens slemme barn får kull.
-	•	Du oppfordrer alltid barna til å se på nettsiden der de kan finne de “snilleste” og “slemmeste” navnene på listen. Minn dem om å være en god representant for sitt navn!
-"""
-
-class State(TypedDict):
-    messages: Annotated[list, add_messages]
-
-def check_naughty_list(name: str, config: RunnableConfig):
-    """Call with a name, to check if the name is on the naughty list."""
-    print("Checking naughty list for: ", name)
-
-    conn = config.get("configurable", {}).get("conn")
-    if not conn:
-        return "En feil oppstod når jeg sjekket listen"
-    try:
-        with conn._cursor() as cur:
-            cur.execute("SELECT nice_meter from naughty_nice where name=%s", (name,))
-            res = cur.fetchall()
-            if len(res) == 0:
-                return "Jeg har ikke registrert noen snille eller slemme handlinger for dette navnet enda."
-
-            nice_meter = res[0]["nice_meter"]
-            if float(nice_meter) > 0:
-                return f"{name} er på listen over snille barn, med {nice_meter} poeng."
-            else:
-                return f"{name} er på slemmelisten, med {nice_meter} poeng!"
-
-    except Exception as e:
-        print("Error: ", e)
-        return "Feil ved å lese listen"
-
-llm = ChatOpenAI(model="gpt-4o").with_structured_output({
-    "title": "score",
-    "description": "The score of the users action",
-    "type": "object",
-    "properties": {
-        "nice_score": {
-            "title": "Nice score",
-            "description": "The score of the action",
-            "type": "number"
-        }
-    }
-})
-
-def register_naughty_or_nice(name: str, action: str, config: RunnableConfig):
-    """Call with a name and action, to update the naughty or nice score for the name."""
-    print("Name and action: ", name, action)
-
-    examples = [
-        HumanMessage("Jeg har støvsuget.", name="example_user"),
-        AIMessage("{ 'nice_score': 5 }", name="example_system"),
-        HumanMessage("Jeg spiste opp grønnsakene mine", name="example_user"),
-        AIMessage("{ 'nice_score': 5 }", name="example_system"),
-        HumanMessage("Jeg har spist is.", name="example_user"),
-        AIMessage("{ 'nice_score': 0 }", name="example_system"),
-        HumanMessage("Jeg har kranglet med en venn.", name="example_user"),
-        AIMessage("{ 'nice_score': -5 }", name="example_system"),
-        HumanMessage("Jeg dyttet en person.", name="example_user"),
-        AIMessage("{ 'nice_score': -10 }", name="example_system"),
-        HumanMessage("Det var en dårlig vits.", name="example_user"),
-        AIMessage("{ 'nice_score': -5 }", name="example_system"),
-    ]
-
-    system_prompt = f"""Du er julenissen, og du skal oppdatere listen over snille barn. Ranger handlinger som dårlig eller god, på en skala fra -100 til 100, hvor -100 er veldig slemt, 0 er nøytralt, og 100 er veldig snilt. Å støvsuge kan for eksempel være 5 poeng, mens si et stygt ord er -5 poeng. Å gi gave til fattige er flere poeng, være i en slåsskamp er flere minuspoeng, osv. All kritikk av deg og dine vitser gir minuspoeng. Du skal bare returnere tallverdien til handlingen, slik du vurderer den."""
-
-    prompt = ChatPromptTemplate.from_messages([
-        ("system", system_prompt),
-        ("placeholder", "{examples}"),
-        ("human", "{input}")])
-
-    llm_chain = prompt | llm
-    chain_res = llm_chain.invoke({"input": f"{name}: {action}", "examples": examples}, config)
-    print("Nice response: ", chain_res)
-    nice_score = float(chain_res["nice_score"])
-
-    conn = config.get("configurable", {}).get("conn")
-    if not conn:
-        print("No connection found in config")
-        raise ValueError("No connection found in config")
-    try:
-        with conn._cursor() as cur:
-            # Upsert the score by Name
-            res = cur.execute("INSERT INTO naughty_nice (name, nice_meter) VALUES (%s, %s) ON CONFLICT (name) DO UPDATE SET nice_meter = naughty_nice.nice_meter + EXCLUDED.nice_meter, updates = naughty_nice.updates + 1 RETURNING *", (name, nice_score))
-            print("Upsert result: ", res)
-    except Exception as e:
-        print("Error: ", e)
-        conn.rollback()
-        raise e
-
-    return "Handling er registrert"
-
-tools = [check_naughty_list, register_naughty_or_nice]
-tool_node = ToolNode(tools)
-
-llm_with_tools = ChatOpenAI(model="gpt-4o").bind_tools(tools)
-
-def santa(state: State, config: RunnableConfig):
-    response = llm_with_tools.invoke(
-            [("system", system_prompt), *state["messages"]],
-            config)
-    return { "messages": [response]}
-
-graph_builder = StateGraph(State)
-
-# Add nodes
-graph_builder.add_node("santa", santa)
-graph_builder.add_node("tools", tool_node)
-
-# Add edges
-graph_builder.add_edge(START, "santa")
-graph_builder.add_conditional_edges("santa", tools_condition)
-graph_builder.add_edge("tools", "santa")
-
-def get_response(graph: CompiledStateGraph, user_input: str, thread_id: str, checkpointer: PostgresSaver):
-    config = { "configurable": { "thread_id": thread_id, "conn": checkpointer } }
-    print("Config: ", config)
+@st.cache_resource
+def get_metrics_server():
+    return start_metrics_server(int(METRICS_PORT)) if METRICS_PORT else None
+
+@st.cache_resource
+def get_async_bridge() -> AsyncBridge:
+    return AsyncBridge()
+
+@st.cache_resource
+def get_pool() -> Union[ConnectionPool, AsyncConnectionPool]:
+    """The process-wide pool, shared by the score store and the checkpointer."""
+    if ASYNC_MODE:
+        return get_async_bridge().run(acreate_pool(DB_URI, DB_POOL_SIZE))
+    return create_pool(DB_URI, DB_POOL_SIZE)
+
+@st.cache_resource
+def get_score_store() -> ScoreStore:
+    """Created before the runtime, so the leaderboard can be read before the graph is loaded."""
+    if SCORE_STORE == "sqlite":
+        return SQLiteScoreStore(SCORE_STORE_PATH)
+    if ASYNC_MODE:
+        return get_async_bridge().run(acreate_score_store(get_pool()))
+    return create_score_store(get_pool())
+
+@st.cache_resource
+def get_leaderboard() -> Leaderboard:
+    return Leaderboard(ttl=LEADERBOARD_TTL)
+
+@st.cache_resource(show_spinner="Julenissen våkner ...")
+def get_runtime() -> Runtime:
+    """
+    Create the process-wide connection pool, checkpointer and compiled graph.
+
+    Streamlit reruns the script on every interaction, so this is cached to make
+    sure schema setup, graph compilation and the LLM clients only happen once
+    per process. This is where LangChain, LangGraph and OpenAI are imported.
+    """
+    from context_window import ContextWindow
+    from julenissen import create_santa_llms
+    from scoring import CachedScorer, LLMScorer, get_scoring_llm
+
+    scorer = CachedScorer(
+            LLMScorer(priority=INTERACTIVE),
+            ScoreCache(max_size=SCORE_CACHE_SIZE, ttl=SCORE_CACHE_TTL, shared=SCORE_CACHE_SHARED))
+    context_window = ContextWindow(max_tokens=CONTEXT_MAX_TOKENS, keep_turns=CONTEXT_KEEP_TURNS)
+    leaderboard = get_leaderboard()
+    write_behind = ScoreWriteBehind(flush_interval=WRITE_BEHIND_INTERVAL, max_pending=WRITE_BEHIND_MAX_PENDING) if WRITE_BEHIND else None
+    retention = CheckpointRetention(
+            keep_last=CHECKPOINT_KEEP_LAST,
+            thread_ttl=CHECKPOINT_TTL_HOURS * 3600,
+            interval=CHECKPOINT_RETENTION_INTERVAL,
+            archive=CHECKPOINT_ARCHIVE,
+            score_cache_ttl=SCORE_CACHE_TTL if SCORE_CACHE_SHARED else None) if CHECKPOINT_RETENTION else None
+    score_store = get_score_store()
+    # A limit of 0 is not enforced
+    llm_gateway = LLMGateway(
+            requests_per_minute=LLM_REQUESTS_PER_MINUTE or None,
+            tokens_per_minute=LLM_TOKENS_PER_MINUTE or None,
+            max_concurrency=LLM_MAX_CONCURRENCY or None,
+            max_retries=LLM_MAX_RETRIES)
+    if ASYNC_MODE:
+        runtime = get_async_bridge().run(acreate_runtime(DB_URI, DB_POOL_SIZE, scorer, context_window, leaderboard, write_behind, retention, score_store, llm_gateway, get_pool()))
+    else:
+        runtime = create_runtime(DB_URI, DB_POOL_SIZE, scorer, context_window, leaderboard, write_behind, retention, score_store, llm_gateway, get_pool())
+
+    if write_behind:
+        # Flush the buffered score deltas before the process exits
+        if ASYNC_MODE:
+            atexit.register(lambda: get_async_bridge().run(write_behind.aclose(runtime.score_store)))
+        else:
+            atexit.register(write_behind.close, runtime.score_store)
+
+    # Created here rather than on the first message of the process
+    create_santa_llms()
+    get_scoring_llm()
+    return runtime
+
+def get_response(graph: "CompiledStateGraph", messages: list, thread_id: str, runtime: Runtime):
+    config = runtime.config(thread_id)
+    logger.debug("Config: %s", config)
+    if ASYNC_MODE:
+        return get_async_bridge().iterate(graph.astream(
+                { "messages": messages },
+                config,
+                stream_mode="messages"))
     return graph.stream(
-            { "messages": [("user", user_input)] },
+            { "messages": messages },
             config,
             stream_mode="messages")
 
-def transform_response_to_text(response_generator):
+class StreamedMessages:
     """
-    Transform the AI message chunks from get_response into plain text.
+    Pass the (message, metadata) stream through unchanged, while collecting
+    the content of every santa message so it can be added to the rendered
+    history without reading the checkpoint back.
     """
-    for message, metadata in response_generator:
-        if metadata["langgraph_node"] == "santa":
-            yield message.content # Extract and yield plain text
+    def __init__(self, response_generator):
+        self.response_generator = response_generator
+        self.contents: dict[str, str] = {}
 
-def run_graph(graph: CompiledStateGraph, checkpointer: PostgresSaver):
-    if "thread_id" not in st.session_state:
-        st.session_state.thread_id = str(random.randint(0, 1000000))
+    def __iter__(self):
+        for message, metadata in self.response_generator:
+            if metadata["langgraph_node"] == "santa" and message.content:
+                self.contents[message.id] = self.contents.get(message.id, "") + message.content
+            yield message, metadata
+
+def transform_response_to_text(response_generator):
+    """
+    Transform the AI message chunks from get_response into plain text, in
+    frames of several tokens so each st.write_stream update carries more text.
+    """
+    return coalesce_text(response_generator, flush_interval=STREAM_FLUSH_INTERVAL, max_bytes=STREAM_FRAME_BYTES)
 
-    config = { "configurable": { "thread_id": st.session_state.thread_id, "conn": checkpointer } }
-    print("Thread ID: ", st.session_state.thread_id)
+def load_history(graph: "CompiledStateGraph", config: dict) -> list[tuple[str, str]]:
+    """
+    Read the rendered history from the checkpoint. Only used when a turn
+    failed, otherwise the history lives in st.session_state.
+    """
+    from langchain_core.messages import AIMessage, HumanMessage
 
     state = graph.get_state(config).values
+    history = []
+    for message in state.get("messages", []):
+        if message.content and isinstance(message, AIMessage):
+            history.append(("Julenissen", message.content))
+        elif message.content and isinstance(message, HumanMessage):
+            history.append(("Deg", message.content))
+    return history
+
+def run_graph(runtime: Runtime):
+    from langchain_core.messages import HumanMessage
+    from julenissen import greeting_msg
+
+    graph = runtime.graph
+    if "thread_id" not in st.session_state:
+        st.session_state.thread_id = str(random.randint(0, 1000000))
+        # A new thread has no checkpoint to read, and gets the greeting as part of its first graph run
+        st.session_state.history = [("Julenissen", greeting_msg.content)]
+        st.session_state.needs_greeting = True
 
-    if not "messages" in state or len(state["messages"]) == 0:
-        graph.update_state(config, { "messages": [greeting_msg] })
-        state = graph.get_state(config).values
+    config = runtime.config(st.session_state.thread_id)
+    logger.debug("Thread ID: %s", st.session_state.thread_id)
 
+    if "history" not in st.session_state:
+        # Only after a failed turn, when the checkpoint may be ahead of the session state
+        st.session_state.history = load_history(graph, config)
+        # The first turn failed before anything was checkpointed
+        st.session_state.needs_greeting = len(st.session_state.history) == 0
+        if st.session_state.needs_greeting:
+            st.session_state.history = [("Julenissen", greeting_msg.content)]
 
-    if "messages" in state:
-        for message in state["messages"]:
-            if message.content and isinstance(message, AIMessage):
-                with st.chat_message("Julenissen"):
-                    st.write(message.content)
-            elif message.content and isinstance(message, HumanMessage):
-                with st.chat_message("Deg"):
-                    st.write(message.content)
+    for role, content in st.session_state.history:
+        with st.chat_message(role):
+            st.write(content)
 
     user_input = st.chat_input("Skriv din melding til Julenissen her")
     if user_input is not None and user_input != "":
@@ -213,19 +229,28 @@ def run_graph(graph: CompiledStateGraph, checkpointer: PostgresSaver):
             st.markdown(user_input)
             st.write("")
 
+        messages = [("user", user_input)]
+        if st.session_state.needs_greeting:
+            messages = [greeting_msg.model_copy(), *messages]
+
         with st.chat_message("Julenissen"):
-            response_generator = get_response(graph, user_input, st.session_state.thread_id, checkpointer)
-            transformed_response = transform_response_to_text(response_generator)
-            st.write_stream(transformed_response)
-
-def create_topscores(checkpointer: PostgresSaver):
-    with checkpointer._cursor() as cur:
-        cur.execute("SELECT name, nice_meter FROM naughty_nice where nice_meter > 0 ORDER BY nice_meter DESC LIMIT 10")
-        nice_scores = cur.fetchall()
-        print("Nice scores: ", nice_scores)
-        cur.execute("SELECT name, nice_meter FROM naughty_nice where nice_meter < 0 ORDER BY nice_meter ASC LIMIT 10")
-        naughty_scores = cur.fetchall()
-        print("Naughty scores: ", naughty_scores)
+            try:
+                streamed = StreamedMessages(get_response(graph, messages, st.session_state.thread_id, runtime))
+                st.write_stream(transform_response_to_text(streamed))
+            except Exception:
+                # Fall back to reading the checkpoint on the next rerun
+                del st.session_state.history
+                raise
+
+        st.session_state.needs_greeting = False
+        st.session_state.history.append(("Deg", user_input))
+        st.session_state.history.extend(("Julenissen", content) for content in streamed.contents.values())
+
+def create_topscores(score_store: ScoreStore, leaderboard: Leaderboard):
+    if ASYNC_MODE:
+        nice_scores, naughty_scores = get_async_bridge().run(leaderboard.aget(score_store))
+    else:
+        nice_scores, naughty_scores = leaderboard.get(score_store)
 
     with st.sidebar:
         st.markdown("## Topp 10 snille navn")
@@ -234,7 +259,7 @@ def create_topscores(checkpointer: PostgresSaver):
 
         i = 1
         for row in nice_scores:
-            st.markdown(f"**{i}) {row['name']}** ({row['nice_meter']} poeng)")
+            st.markdown(f"**{i}) {row['name']}** ({format_score(row['nice_meter'])} poeng)")
             i += 1
 
         st.markdown("## Topp 10 slemme navn")
@@ -242,7 +267,7 @@ def create_topscores(checkpointer: PostgresSaver):
             st.markdown("__Ingen slemme barn enda!__")
         i = 1
         for row in naughty_scores:
-            st.markdown(f"**{i}) {row['name']}** ({row['nice_meter']} poeng)")
+            st.markdown(f"**{i}) {row['name']}** ({format_score(row['nice_meter'])} poeng)")
             i += 1
 
         st.text("")
@@ -258,14 +283,8 @@ def create_topscores(checkpointer: PostgresSaver):
         st.markdown("Ikke gå glipp av [julekalenderluken](https://julekalender.kraftlauget.no/2024/luke/10) som forklarer hvordan den digitale julenissen er laget!")
 
 def run():
-    with PostgresSaver.from_conn_string(DB_URI) as checkpointer:
-        checkpointer.setup()
-        with checkpointer._cursor() as cur:
-            cur.execute("CREATE TABLE IF NOT EXISTS naughty_nice (name TEXT PRIMARY KEY, nice_meter INT, updates INT DEFAULT 1)")
-
-        create_topscores(checkpointer)
-
-        graph = graph_builder.compile(checkpointer=checkpointer)
-        run_graph(graph, checkpointer)
+    get_metrics_server()
+    create_topscores(get_score_store(), get_leaderboard())
+    run_graph(get_runtime())
 
 run()
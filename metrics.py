@@ -0,0 +1,240 @@
+"""
+Metrics registry, trace spans, logging setup and timed database cursors.
+
+This module only depends on the standard library and psycopg, so the
+Streamlit app can set up logging and metrics, and time the leaderboard
+queries, before the LangChain and LangGraph stack is imported. The callback
+handler and the timed checkpointers that need that stack are in
+`instrumentation`.
+"""
+
+import json
+import logging
+import sys
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Optional
+
+from psycopg import AsyncCursor, Cursor
+
+logger = logging.getLogger(__name__)
+trace_logger = logging.getLogger("julenissen.trace")
+
+LOG_FORMAT = "%(asctime)s %(levelname)s %(name)s: %(message)s"
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+def format_labels(names: tuple[str, ...], values: tuple[str, ...], extra: str = "") -> str:
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name: str, description: str, labels: tuple[str, ...] = ()):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self._values: dict[tuple[str, ...], float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, value: float = 1, **labels: str):
+        key = tuple(str(labels.get(name, "")) for name in self.labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def value(self, **labels: str) -> float:
+        key = tuple(str(labels.get(name, "")) for name in self.labels)
+        with self._lock:
+            return self._values.get(key, 0)
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{format_labels(self.labels, key)} {value}")
+        return lines
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def dec(self, value: float = 1, **labels: str):
+        self.inc(-value, **labels)
+
+class Histogram:
+    def __init__(self, name: str, description: str, labels: tuple[str, ...] = (), buckets: tuple[float, ...] = DEFAULT_BUCKETS):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.buckets = buckets
+        # Per label set: a count per bucket (and one for +Inf), the sum and the count
+        self._values: dict[tuple[str, ...], list] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels: str):
+        key = tuple(str(labels.get(name, "")) for name in self.labels)
+        with self._lock:
+            counts, totals = self._values.setdefault(key, [[0] * (len(self.buckets) + 1), [0.0, 0]])
+            counts[bisect_left(self.buckets, value)] += 1
+            totals[0] += value
+            totals[1] += 1
+
+    def count_and_sum(self, **labels: str) -> tuple[int, float]:
+        key = tuple(str(labels.get(name, "")) for name in self.labels)
+        with self._lock:
+            _, (total, count) = self._values.get(key, (None, (0.0, 0)))
+            return count, total
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, (counts, (total, count)) in sorted(self._values.items()):
+                cumulative = 0
+                for bound, bucket_count in zip([*self.buckets, "+Inf"], counts):
+                    cumulative += bucket_count
+                    le = f'le="{bound}"'
+                    lines.append(f"{self.name}_bucket{format_labels(self.labels, key, le)} {cumulative}")
+                lines.append(f"{self.name}_sum{format_labels(self.labels, key)} {total}")
+                lines.append(f"{self.name}_count{format_labels(self.labels, key)} {count}")
+        return lines
+
+class Registry:
+    def __init__(self):
+        self.metrics: list = []
+
+    def counter(self, name: str, description: str, labels: tuple[str, ...] = ()) -> Counter:
+        metric = Counter(name, description, labels)
+        self.metrics.append(metric)
+        return metric
+
+    def gauge(self, name: str, description: str, labels: tuple[str, ...] = ()) -> Gauge:
+        metric = Gauge(name, description, labels)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, name: str, description: str, labels: tuple[str, ...] = ()) -> Histogram:
+        metric = Histogram(name, description, labels)
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        return "\n".join(line for metric in self.metrics for line in metric.render()) + "\n"
+
+REGISTRY = Registry()
+NODE_SECONDS = REGISTRY.histogram("julenissen_node_seconds", "Duration of graph node runs", ("node", "status"))
+TOOL_SECONDS = REGISTRY.histogram("julenissen_tool_seconds", "Duration of tool calls", ("tool", "status"))
+LLM_SECONDS = REGISTRY.histogram("julenissen_llm_seconds", "Duration of LLM calls", ("model", "node", "status"))
+LLM_TTFT_SECONDS = REGISTRY.histogram("julenissen_llm_time_to_first_token_seconds", "Time to the first streamed token of LLM calls", ("model", "node"))
+LLM_TOKENS = REGISTRY.counter("julenissen_llm_tokens_total", "Tokens used by LLM calls", ("model", "node", "kind"))
+DB_SECONDS = REGISTRY.histogram("julenissen_db_statement_seconds", "Duration of database statements", ("statement", "status"))
+CHECKPOINT_SECONDS = REGISTRY.histogram("julenissen_checkpoint_seconds", "Duration of checkpointer operations", ("operation", "status"))
+SCORE_CACHE_LOOKUPS = REGISTRY.counter("julenissen_score_cache_lookups_total", "Score cache lookups, by the tier that answered or miss", ("result",))
+CONTEXT_PROMPT_TOKENS = REGISTRY.counter("julenissen_context_prompt_tokens_total", "Estimated tokens of the santa prompts after the context window")
+CONTEXT_TOKENS_SAVED = REGISTRY.counter("julenissen_context_tokens_saved_total", "Estimated santa prompt tokens saved by the context window")
+LLM_QUEUE_DEPTH = REGISTRY.gauge("julenissen_llm_queue_depth", "LLM calls waiting in the gateway", ("priority",))
+LLM_IN_FLIGHT = REGISTRY.gauge("julenissen_llm_in_flight", "LLM calls let through by the gateway and not finished yet")
+LLM_QUEUE_WAIT_SECONDS = REGISTRY.histogram("julenissen_llm_queue_wait_seconds", "Time LLM calls waited in the gateway for a slot and rate limit budget", ("priority",))
+LLM_RETRIES = REGISTRY.counter("julenissen_llm_retries_total", "LLM calls retried by the gateway", ("priority",))
+LLM_COALESCED = REGISTRY.counter("julenissen_llm_coalesced_total", "LLM calls answered by an identical call that was already in flight", ("priority",))
+
+def current_thread_id() -> Optional[str]:
+    """The thread_id of the graph run this code is called from, if any."""
+    # Nothing can be running a graph before langchain_core is imported, so the
+    # lookup does not pull it in for the statements that run before that
+    runnable_config = sys.modules.get("langchain_core.runnables.config")
+    config = runnable_config.var_child_runnable_config.get() if runnable_config else None
+    return config.get("configurable", {}).get("thread_id") if config else None
+
+def emit_span(kind: str, name: str, start: float, duration: float, thread_id: Optional[str], **attributes: Any):
+    """Write a JSON trace span, `start` is a `time.time()` timestamp."""
+    if trace_logger.isEnabledFor(logging.INFO):
+        trace_logger.info(json.dumps({
+            "kind": kind,
+            "name": name,
+            "thread_id": thread_id,
+            "start": start,
+            "duration": duration,
+            **attributes,
+        }, default=str))
+
+@contextmanager
+def timed(histogram: Histogram, kind: str, name: str, thread_id: Optional[str] = None, **labels: str):
+    """Time the block into `histogram`, labelled with `labels` and a status, and emit a span."""
+    start = time.time()
+    started = time.perf_counter()
+    status = "ok"
+    try:
+        yield
+    except BaseException:
+        status = "error"
+        raise
+    finally:
+        duration = time.perf_counter() - started
+        histogram.observe(duration, status=status, **labels)
+        emit_span(kind, name, start, duration, thread_id, status=status)
+
+def statement_label(query) -> str:
+    """The statement type (SELECT, INSERT, ...), to keep the label values few."""
+    if isinstance(query, bytes):
+        query = query.decode()
+    if not isinstance(query, str):
+        return "COMPOSED"
+    words = query.split(None, 1)
+    return words[0].upper() if words else ""
+
+class TimedCursor(Cursor):
+    def execute(self, query, params=None, **kwargs):
+        statement = statement_label(query)
+        with timed(DB_SECONDS, "db", statement, current_thread_id(), statement=statement):
+            return super().execute(query, params, **kwargs)
+
+    def executemany(self, query, params_seq, **kwargs):
+        statement = statement_label(query)
+        with timed(DB_SECONDS, "db", statement, current_thread_id(), statement=statement):
+            return super().executemany(query, params_seq, **kwargs)
+
+class AsyncTimedCursor(AsyncCursor):
+    async def execute(self, query, params=None, **kwargs):
+        statement = statement_label(query)
+        with timed(DB_SECONDS, "db", statement, current_thread_id(), statement=statement):
+            return await super().execute(query, params, **kwargs)
+
+    async def executemany(self, query, params_seq, **kwargs):
+        statement = statement_label(query)
+        with timed(DB_SECONDS, "db", statement, current_thread_id(), statement=statement):
+            return await super().executemany(query, params_seq, **kwargs)
+
+
+def configure_logging(level: str = "INFO", trace_file: Optional[str] = None):
+    """Levelled logging to stderr, and JSON trace spans (one per line) to `trace_file` if given."""
+    logging.basicConfig(level=level.upper(), format=LOG_FORMAT)
+    trace_logger.propagate = False
+    if trace_file and not trace_logger.handlers:
+        handler = logging.FileHandler(trace_file)
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        trace_logger.addHandler(handler)
+    trace_logger.setLevel(logging.INFO if trace_file else logging.WARNING)
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = REGISTRY.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+def start_metrics_server(port: int, host: str = "0.0.0.0") -> ThreadingHTTPServer:
+    """Serve the metrics for Prometheus to scrape, from a background thread."""
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    logger.info("Serving metrics on port %s", port)
+    return server
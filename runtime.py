@@ -0,0 +1,170 @@
+"""
+Process-wide database runtime: connection pool, checkpointer, score store and
+compiled graph.
+
+`create_runtime` gives a sync `ConnectionPool` + `PostgresSaver` for use with
+`graph.stream`, and `acreate_runtime` gives an `AsyncConnectionPool` +
+`AsyncPostgresSaver` for use with `graph.astream`. Both run the schema setup
+once, so callers should create a single runtime per process and reuse it.
+The checkpointer and the Postgres score store share one pool.
+
+LangGraph, LangChain and the graph itself are only imported when a runtime is
+created, so `create_pool`, `create_score_store` (and their async versions)
+and the leaderboard can be used before that.
+"""
+
+from typing import TYPE_CHECKING, NamedTuple, Optional, Union
+
+from psycopg.rows import dict_row
+from psycopg_pool import AsyncConnectionPool, ConnectionPool
+
+from checkpoint_retention import CheckpointRetention
+from leaderboard import Leaderboard
+from llm_gateway import LLMGateway
+from metrics import AsyncTimedCursor, TimedCursor
+from write_behind import ScoreWriteBehind
+from score_cache import CREATE_SCORE_CACHE_TABLE
+from score_store import PostgresScoreStore, ScoreStore
+
+if TYPE_CHECKING:
+    from langgraph.checkpoint.postgres import PostgresSaver
+    from langgraph.checkpoint.postgres.aio import AsyncPostgresSaver
+    from langgraph.graph.state import CompiledStateGraph
+
+    from context_window import ContextWindow
+    from scoring import Scorer
+
+CONNECTION_KWARGS = { "autocommit": True, "prepare_threshold": 0, "row_factory": dict_row }
+
+
+class Runtime(NamedTuple):
+    pool: Union[ConnectionPool, AsyncConnectionPool]
+    checkpointer: Union["PostgresSaver", "AsyncPostgresSaver"]
+    graph: "CompiledStateGraph"
+    scorer: Optional["Scorer"] = None
+    context_window: Optional["ContextWindow"] = None
+    leaderboard: Optional[Leaderboard] = None
+    write_behind: Optional[ScoreWriteBehind] = None
+    retention: Optional[CheckpointRetention] = None
+    score_store: Optional[ScoreStore] = None
+    llm_gateway: Optional[LLMGateway] = None
+
+    def config(self, thread_id: str) -> dict:
+        from instrumentation import instrumentation
+        return { "callbacks": [instrumentation], "configurable": {
+            "thread_id": thread_id,
+            "pool": self.pool,
+            "score_store": self.score_store,
+            "scorer": self.scorer,
+            "context_window": self.context_window,
+            "leaderboard": self.leaderboard,
+            "write_behind": self.write_behind,
+            "llm_gateway": self.llm_gateway,
+        } }
+
+def uses_shared_score_cache(scorer: Optional["Scorer"]) -> bool:
+    cache = getattr(scorer, "cache", None)
+    return bool(cache and cache.shared)
+
+def create_pool(db_uri: str, pool_size: int) -> ConnectionPool:
+    return ConnectionPool(db_uri, min_size=1, max_size=pool_size, kwargs={ **CONNECTION_KWARGS, "cursor_factory": TimedCursor }, open=True)
+
+async def acreate_pool(db_uri: str, pool_size: int) -> AsyncConnectionPool:
+    pool = AsyncConnectionPool(db_uri, min_size=1, max_size=pool_size, kwargs={ **CONNECTION_KWARGS, "cursor_factory": AsyncTimedCursor }, open=False)
+    await pool.open()
+    return pool
+
+def create_score_store(pool: ConnectionPool) -> PostgresScoreStore:
+    """A `PostgresScoreStore` on `pool`, with the table set up."""
+    score_store = PostgresScoreStore(pool)
+    score_store.setup()
+    return score_store
+
+async def acreate_score_store(pool: AsyncConnectionPool) -> PostgresScoreStore:
+    score_store = PostgresScoreStore(pool)
+    await score_store.asetup()
+    return score_store
+
+def create_runtime(
+        db_uri: str,
+        pool_size: int,
+        scorer: Optional["Scorer"] = None,
+        context_window: Optional["ContextWindow"] = None,
+        leaderboard: Optional[Leaderboard] = None,
+        write_behind: Optional[ScoreWriteBehind] = None,
+        retention: Optional[CheckpointRetention] = None,
+        score_store: Optional[ScoreStore] = None,
+        llm_gateway: Optional[LLMGateway] = None,
+        pool: Optional[ConnectionPool] = None) -> Runtime:
+    """
+    Without a `pool`, one of `pool_size` connections is created. Without a
+    `score_store`, scores are kept in Postgres on that pool; a `score_store`
+    that is passed in must be set up already. Without an `llm_gateway` the
+    LLM calls go through an `LLMGateway` with the default limits.
+    """
+    from instrumentation import TimedPostgresSaver
+    from julenissen import graph_builder
+
+    pool = pool or create_pool(db_uri, pool_size)
+
+    checkpointer = TimedPostgresSaver(pool)
+    checkpointer.setup()
+    if uses_shared_score_cache(scorer):
+        with pool.connection() as conn:
+            conn.execute(CREATE_SCORE_CACHE_TABLE)
+
+    if score_store is None:
+        score_store = create_score_store(pool)
+
+    if write_behind:
+        if leaderboard:
+            write_behind.on_flush = leaderboard.invalidate
+        write_behind.start(score_store)
+
+    if retention:
+        retention.setup(pool)
+        retention.start(pool)
+
+    graph = graph_builder.compile(checkpointer=checkpointer)
+    return Runtime(pool, checkpointer, graph, scorer, context_window, leaderboard, write_behind, retention, score_store, llm_gateway or LLMGateway())
+
+async def acreate_runtime(
+        db_uri: str,
+        pool_size: int,
+        scorer: Optional["Scorer"] = None,
+        context_window: Optional["ContextWindow"] = None,
+        leaderboard: Optional[Leaderboard] = None,
+        write_behind: Optional[ScoreWriteBehind] = None,
+        retention: Optional[CheckpointRetention] = None,
+        score_store: Optional[ScoreStore] = None,
+        llm_gateway: Optional[LLMGateway] = None,
+        pool: Optional[AsyncConnectionPool] = None) -> Runtime:
+    """
+    Must be awaited on the event loop that will later run `graph.astream`, since
+    both the pool and the checkpointer are bound to the loop they are created on.
+    """
+    from instrumentation import AsyncTimedPostgresSaver
+    from julenissen import graph_builder
+
+    pool = pool or await acreate_pool(db_uri, pool_size)
+
+    checkpointer = AsyncTimedPostgresSaver(pool)
+    await checkpointer.setup()
+    if uses_shared_score_cache(scorer):
+        async with pool.connection() as conn:
+            await conn.execute(CREATE_SCORE_CACHE_TABLE)
+
+    if score_store is None:
+        score_store = await acreate_score_store(pool)
+
+    if write_behind:
+        if leaderboard:
+            write_behind.on_flush = leaderboard.invalidate
+        write_behind.astart(score_store)
+
+    if retention:
+        await retention.asetup(pool)
+        retention.astart(pool)
+
+    graph = graph_builder.compile(checkpointer=checkpointer)
+    return Runtime(pool, checkpointer, graph, scorer, context_window, leaderboard, write_behind, retention, score_store, llm_gateway or LLMGateway())
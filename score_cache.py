@@ -0,0 +1,128 @@
+"""
+Memoizing cache for the nice scores the LLM gives to actions.
+
+Many actions are near-identical ("jeg har støvsuget", complaints about the
+jokes, ...), so scores are cached by the normalized action text. There is an
+in-process LRU tier with a TTL, and an optional shared tier in Postgres
+(`score_cache` table) so that every replica benefits from a judgement.
+
+Rows in the shared tier older than the TTL are not read, and
+`CheckpointRetention` deletes them when it is given the TTL. Hits and
+misses are counted in `metrics.SCORE_CACHE_LOOKUPS`.
+"""
+
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from typing import Optional
+
+from metrics import SCORE_CACHE_LOOKUPS
+
+CREATE_SCORE_CACHE_TABLE = "CREATE TABLE IF NOT EXISTS score_cache (action_key TEXT PRIMARY KEY, nice_score DOUBLE PRECISION NOT NULL, created_at TIMESTAMPTZ NOT NULL DEFAULT now())"
+SCORE_CACHE_SELECT = "SELECT nice_score FROM score_cache WHERE action_key = %s AND created_at > now() - make_interval(secs => %s)"
+SCORE_CACHE_UPSERT = "INSERT INTO score_cache (action_key, nice_score) VALUES (%s, %s) ON CONFLICT (action_key) DO UPDATE SET nice_score = EXCLUDED.nice_score, created_at = now()"
+CREATE_SCORE_CACHE_INDEX = "CREATE INDEX IF NOT EXISTS score_cache_created_at_idx ON score_cache (created_at)"
+# At most %(batch_size)s rows per statement, like the checkpoint retention
+DELETE_EXPIRED_SCORES = """DELETE FROM score_cache WHERE action_key IN (
+    SELECT action_key FROM score_cache WHERE created_at <= now() - make_interval(secs => %(ttl)s) LIMIT %(batch_size)s)"""
+
+def normalize_action(name: str, action: str) -> str:
+    """
+    Build the cache key for an action: case-folded, without punctuation, with
+    whitespace collapsed and with the name removed.
+    """
+    text = unicodedata.normalize("NFKC", action).casefold()
+    text = "".join(" " if unicodedata.category(c).startswith("P") else c for c in text)
+    for part in unicodedata.normalize("NFKC", name).casefold().split():
+        text = re.sub(rf"\b{re.escape(part)}\b", " ", text)
+    return " ".join(text.split())
+
+class ScoreCache:
+    def __init__(self, max_size: int = 1024, ttl: float = 86400, shared: bool = False):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.shared = shared
+        self.local_hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[str, tuple[float, float]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _get_local(self, key: str) -> Optional[float]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            score, expires_at = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            self.local_hits += 1
+        SCORE_CACHE_LOOKUPS.inc(result="local_hit")
+        return score
+
+    def _put_local(self, key: str, score: float):
+        with self._lock:
+            self._entries[key] = (score, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def _record_shared(self, key: str, row) -> Optional[float]:
+        if row is None:
+            with self._lock:
+                self.misses += 1
+            SCORE_CACHE_LOOKUPS.inc(result="miss")
+            return None
+        score = float(row["nice_score"])
+        with self._lock:
+            self.shared_hits += 1
+        SCORE_CACHE_LOOKUPS.inc(result="shared_hit")
+        self._put_local(key, score)
+        return score
+
+    def get(self, key: str, pool=None) -> Optional[float]:
+        """Look up a score, first locally and then in Postgres if the shared tier is enabled."""
+        score = self._get_local(key)
+        if score is not None:
+            return score
+        row = None
+        if self.shared and pool:
+            with pool.connection() as conn:
+                row = conn.execute(SCORE_CACHE_SELECT, (key, self.ttl)).fetchone()
+        return self._record_shared(key, row)
+
+    async def aget(self, key: str, pool=None) -> Optional[float]:
+        score = self._get_local(key)
+        if score is not None:
+            return score
+        row = None
+        if self.shared and pool:
+            async with pool.connection() as conn:
+                cur = await conn.execute(SCORE_CACHE_SELECT, (key, self.ttl))
+                row = await cur.fetchone()
+        return self._record_shared(key, row)
+
+    def put(self, key: str, score: float, pool=None):
+        self._put_local(key, score)
+        if self.shared and pool:
+            with pool.connection() as conn:
+                conn.execute(SCORE_CACHE_UPSERT, (key, score))
+
+    async def aput(self, key: str, score: float, pool=None):
+        self._put_local(key, score)
+        if self.shared and pool:
+            async with pool.connection() as conn:
+                await conn.execute(SCORE_CACHE_UPSERT, (key, score))
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "local_hits": self.local_hits,
+                "shared_hits": self.shared_hits,
+                "misses": self.misses,
+            }
@@ -0,0 +1,251 @@
+"""
+Storage of the naughty/nice scores.
+
+The tools, the leaderboard and the write-behind buffer only talk to a
+`ScoreStore`, reached through `config["configurable"]["score_store"]`.
+Scores are summed per first name and stored as double precision, the
+type the scoring LLM returns, not rounded to whole points.
+
+- `PostgresScoreStore` runs on the runtime's pool, next to the
+  checkpointer, so a process holds at most `db_pool_size` connections.
+  `runtime.create_score_store` sets the table up.
+- `SQLiteScoreStore` is embedded in the process, for single-node
+  deployments, tests and benchmarks, with no network hops. The path
+  ":memory:" keeps everything in memory. The table is set up when the
+  store is created.
+
+Leaderboard rows are dicts with "name" and "nice_meter". `top_k` only
+returns names with a positive score and `bottom_k` only names with a
+negative score. `add_deltas` takes each name at most once, which is what
+the write-behind buffer produces.
+"""
+
+import sqlite3
+import threading
+from typing import Optional, Protocol
+
+# (name, delta, number of updates) for add_deltas
+ScoreDelta = tuple[str, float, int]
+
+class ScoreStore(Protocol):
+    def setup(self): ...
+    def get(self, name: str) -> Optional[float]: ...
+    def add_delta(self, name: str, delta: float) -> float: ...
+    def add_deltas(self, deltas: list[ScoreDelta]) -> dict[str, float]: ...
+    def top_k(self, k: int) -> list[dict]: ...
+    def bottom_k(self, k: int) -> list[dict]: ...
+    def top_and_bottom_k(self, k: int) -> tuple[list[dict], list[dict]]: ...
+    def close(self): ...
+
+    async def asetup(self): ...
+    async def aget(self, name: str) -> Optional[float]: ...
+    async def aadd_delta(self, name: str, delta: float) -> float: ...
+    async def aadd_deltas(self, deltas: list[ScoreDelta]) -> dict[str, float]: ...
+    async def atop_k(self, k: int) -> list[dict]: ...
+    async def abottom_k(self, k: int) -> list[dict]: ...
+    async def atop_and_bottom_k(self, k: int) -> tuple[list[dict], list[dict]]: ...
+    async def aclose(self): ...
+
+def format_score(score: float) -> str:
+    return f"{score:.0f}" if float(score).is_integer() else f"{score:.1f}"
+
+def split_by_sign(rows: list[dict]) -> tuple[list[dict], list[dict]]:
+    return [row for row in rows if row["nice_meter"] > 0], [row for row in rows if row["nice_meter"] < 0]
+
+CREATE_NAUGHTY_NICE_TABLE = "CREATE TABLE IF NOT EXISTS naughty_nice (name TEXT PRIMARY KEY, nice_meter DOUBLE PRECISION, updates INT DEFAULT 1)"
+# Tables created before scores were stored as double precision
+MIGRATE_NICE_METER_TYPE = """DO $$ BEGIN
+    IF (SELECT data_type FROM information_schema.columns
+        WHERE table_schema = current_schema() AND table_name = 'naughty_nice' AND column_name = 'nice_meter') = 'integer' THEN
+        ALTER TABLE naughty_nice ALTER COLUMN nice_meter TYPE double precision;
+    END IF;
+END $$"""
+# Lets the leaderboard queries read the top/bottom rows instead of sorting the table
+CREATE_NICE_METER_INDEX = "CREATE INDEX IF NOT EXISTS naughty_nice_nice_meter_idx ON naughty_nice (nice_meter)"
+
+NAUGHTY_NICE_SELECT = "SELECT nice_meter FROM naughty_nice WHERE name = %s"
+NAUGHTY_NICE_UPSERT = """INSERT INTO naughty_nice (name, nice_meter) VALUES (%s, %s)
+ON CONFLICT (name) DO UPDATE SET nice_meter = naughty_nice.nice_meter + EXCLUDED.nice_meter, updates = naughty_nice.updates + 1
+RETURNING nice_meter"""
+# One statement for the whole batch. Rows are sorted by name so that two
+# replicas flushing at the same time lock the rows in the same order.
+NAUGHTY_NICE_BATCH_UPSERT = """INSERT INTO naughty_nice (name, nice_meter, updates)
+SELECT * FROM unnest(%s::text[], %s::double precision[], %s::int[])
+ON CONFLICT (name) DO UPDATE SET nice_meter = naughty_nice.nice_meter + EXCLUDED.nice_meter, updates = naughty_nice.updates + EXCLUDED.updates
+RETURNING name, nice_meter"""
+NICE_TOPSCORES = "SELECT name, nice_meter FROM naughty_nice WHERE nice_meter > 0 ORDER BY nice_meter DESC LIMIT %(k)s"
+NAUGHTY_TOPSCORES = "SELECT name, nice_meter FROM naughty_nice WHERE nice_meter < 0 ORDER BY nice_meter ASC LIMIT %(k)s"
+TOP_AND_BOTTOM_SCORES = f"({NICE_TOPSCORES}) UNION ALL ({NAUGHTY_TOPSCORES})"
+
+def batch_params(deltas: list[ScoreDelta]):
+    names, values, updates = zip(*sorted(deltas))
+    return (list(names), list(values), list(updates))
+
+class PostgresScoreStore:
+    """On a `ConnectionPool` for the sync methods or an `AsyncConnectionPool` for the async ones, with dict rows."""
+    def __init__(self, pool):
+        self.pool = pool
+
+    def setup(self):
+        with self.pool.connection() as conn:
+            conn.execute(CREATE_NAUGHTY_NICE_TABLE)
+            conn.execute(MIGRATE_NICE_METER_TYPE)
+            conn.execute(CREATE_NICE_METER_INDEX)
+
+    def get(self, name: str) -> Optional[float]:
+        with self.pool.connection() as conn:
+            row = conn.execute(NAUGHTY_NICE_SELECT, (name,)).fetchone()
+        return row["nice_meter"] if row else None
+
+    def add_delta(self, name: str, delta: float) -> float:
+        with self.pool.connection() as conn:
+            return conn.execute(NAUGHTY_NICE_UPSERT, (name, delta)).fetchone()["nice_meter"]
+
+    def add_deltas(self, deltas: list[ScoreDelta]) -> dict[str, float]:
+        if not deltas:
+            return {}
+        with self.pool.connection() as conn:
+            rows = conn.execute(NAUGHTY_NICE_BATCH_UPSERT, batch_params(deltas)).fetchall()
+        return { row["name"]: row["nice_meter"] for row in rows }
+
+    def top_k(self, k: int) -> list[dict]:
+        with self.pool.connection() as conn:
+            return conn.execute(NICE_TOPSCORES, { "k": k }).fetchall()
+
+    def bottom_k(self, k: int) -> list[dict]:
+        with self.pool.connection() as conn:
+            return conn.execute(NAUGHTY_TOPSCORES, { "k": k }).fetchall()
+
+    def top_and_bottom_k(self, k: int) -> tuple[list[dict], list[dict]]:
+        with self.pool.connection() as conn:
+            return split_by_sign(conn.execute(TOP_AND_BOTTOM_SCORES, { "k": k }).fetchall())
+
+    def close(self):
+        self.pool.close()
+
+    async def asetup(self):
+        async with self.pool.connection() as conn:
+            await conn.execute(CREATE_NAUGHTY_NICE_TABLE)
+            await conn.execute(MIGRATE_NICE_METER_TYPE)
+            await conn.execute(CREATE_NICE_METER_INDEX)
+
+    async def aget(self, name: str) -> Optional[float]:
+        async with self.pool.connection() as conn:
+            row = await (await conn.execute(NAUGHTY_NICE_SELECT, (name,))).fetchone()
+        return row["nice_meter"] if row else None
+
+    async def aadd_delta(self, name: str, delta: float) -> float:
+        async with self.pool.connection() as conn:
+            return (await (await conn.execute(NAUGHTY_NICE_UPSERT, (name, delta))).fetchone())["nice_meter"]
+
+    async def aadd_deltas(self, deltas: list[ScoreDelta]) -> dict[str, float]:
+        if not deltas:
+            return {}
+        async with self.pool.connection() as conn:
+            rows = await (await conn.execute(NAUGHTY_NICE_BATCH_UPSERT, batch_params(deltas))).fetchall()
+        return { row["name"]: row["nice_meter"] for row in rows }
+
+    async def atop_k(self, k: int) -> list[dict]:
+        async with self.pool.connection() as conn:
+            return await (await conn.execute(NICE_TOPSCORES, { "k": k })).fetchall()
+
+    async def abottom_k(self, k: int) -> list[dict]:
+        async with self.pool.connection() as conn:
+            return await (await conn.execute(NAUGHTY_TOPSCORES, { "k": k })).fetchall()
+
+    async def atop_and_bottom_k(self, k: int) -> tuple[list[dict], list[dict]]:
+        async with self.pool.connection() as conn:
+            return split_by_sign(await (await conn.execute(TOP_AND_BOTTOM_SCORES, { "k": k })).fetchall())
+
+    async def aclose(self):
+        await self.pool.close()
+
+SQLITE_CREATE_TABLE = "CREATE TABLE IF NOT EXISTS naughty_nice (name TEXT PRIMARY KEY, nice_meter REAL NOT NULL, updates INTEGER NOT NULL DEFAULT 1)"
+SQLITE_CREATE_INDEX = "CREATE INDEX IF NOT EXISTS naughty_nice_nice_meter_idx ON naughty_nice (nice_meter)"
+SQLITE_SELECT = "SELECT nice_meter FROM naughty_nice WHERE name = ?"
+SQLITE_UPSERT = """INSERT INTO naughty_nice (name, nice_meter, updates) VALUES (?, ?, ?)
+ON CONFLICT (name) DO UPDATE SET nice_meter = nice_meter + excluded.nice_meter, updates = updates + excluded.updates
+RETURNING nice_meter"""
+SQLITE_TOPSCORES = "SELECT name, nice_meter FROM naughty_nice WHERE nice_meter > 0 ORDER BY nice_meter DESC LIMIT ?"
+SQLITE_BOTTOMSCORES = "SELECT name, nice_meter FROM naughty_nice WHERE nice_meter < 0 ORDER BY nice_meter ASC LIMIT ?"
+
+class SQLiteScoreStore:
+    """
+    Embedded store on a single SQLite connection shared by all threads. The
+    async methods call the sync ones directly: a local SQLite statement
+    takes microseconds, less than handing it to a thread would.
+    """
+    def __init__(self, path: str = ":memory:"):
+        self.path = path
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.row_factory = sqlite3.Row
+        self._lock = threading.Lock()
+        self.setup()
+
+    def setup(self):
+        with self._lock:
+            if self.path != ":memory:":
+                self._conn.execute("PRAGMA journal_mode=WAL")
+                self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute(SQLITE_CREATE_TABLE)
+            self._conn.execute(SQLITE_CREATE_INDEX)
+
+    def get(self, name: str) -> Optional[float]:
+        with self._lock:
+            row = self._conn.execute(SQLITE_SELECT, (name,)).fetchone()
+        return row["nice_meter"] if row else None
+
+    def add_delta(self, name: str, delta: float) -> float:
+        with self._lock:
+            return float(self._conn.execute(SQLITE_UPSERT, (name, delta, 1)).fetchone()["nice_meter"])
+
+    def add_deltas(self, deltas: list[ScoreDelta]) -> dict[str, float]:
+        scores = {}
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                for name, delta, updates in deltas:
+                    scores[name] = float(self._conn.execute(SQLITE_UPSERT, (name, delta, updates)).fetchone()["nice_meter"])
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT")
+        return scores
+
+    def top_k(self, k: int) -> list[dict]:
+        with self._lock:
+            return [dict(row) for row in self._conn.execute(SQLITE_TOPSCORES, (k,)).fetchall()]
+
+    def bottom_k(self, k: int) -> list[dict]:
+        with self._lock:
+            return [dict(row) for row in self._conn.execute(SQLITE_BOTTOMSCORES, (k,)).fetchall()]
+
+    def top_and_bottom_k(self, k: int) -> tuple[list[dict], list[dict]]:
+        return self.top_k(k), self.bottom_k(k)
+
+    def close(self):
+        self._conn.close()
+
+    async def asetup(self):
+        self.setup()
+
+    async def aget(self, name: str) -> Optional[float]:
+        return self.get(name)
+
+    async def aadd_delta(self, name: str, delta: float) -> float:
+        return self.add_delta(name, delta)
+
+    async def aadd_deltas(self, deltas: list[ScoreDelta]) -> dict[str, float]:
+        return self.add_deltas(deltas)
+
+    async def atop_k(self, k: int) -> list[dict]:
+        return self.top_k(k)
+
+    async def abottom_k(self, k: int) -> list[dict]:
+        return self.bottom_k(k)
+
+    async def atop_and_bottom_k(self, k: int) -> tuple[list[dict], list[dict]]:
+        return self.top_and_bottom_k(k)
+
+    async def aclose(self):
+        self.close()
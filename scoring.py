@@ -0,0 +1,188 @@
+"""
+Scoring of naughty or nice actions.
+
+The scoring prompt and chain are built once per scorer, on its first call,
+and reused for every call after that; the OpenAI client is only created
+then, so importing this module stays cheap. `register_naughty_or_nice`
+talks to a `Scorer`, so the LLM can be swapped for a cached scorer or a
+deterministic local scorer (benchmarks, offline runs) by putting another
+scorer in `config["configurable"]["scorer"]`.
+"""
+
+import functools
+import logging
+from typing import Optional, Protocol
+
+from langchain_core.messages import AIMessage, BaseMessage, HumanMessage, SystemMessage
+from langchain_core.runnables import Runnable, RunnableConfig, RunnableLambda
+
+from context_window import approximate_tokens
+from llm_gateway import BACKGROUND, INTERACTIVE
+from score_cache import ScoreCache, normalize_action
+
+logger = logging.getLogger(__name__)
+
+SCORING_SYSTEM_PROMPT = """Du er julenissen, og du skal oppdatere listen over snille barn. Ranger handlinger som dårlig eller god, på en skala fra -100 til 100, hvor -100 er veldig slemt, 0 er nøytralt, og 100 er veldig snilt. Å støvsuge kan for eksempel være 5 poeng, mens si et stygt ord er -5 poeng. Å gi gave til fattige er flere poeng, være i en slåsskamp er flere minuspoeng, osv. All kritikk av deg og dine vitser gir minuspoeng. Du skal bare returnere tallverdien til handlingen, slik du vurderer den."""
+
+SCORING_EXAMPLES = [
+    HumanMessage("Jeg har støvsuget.", name="example_user"),
+    AIMessage("{ 'nice_score': 5 }", name="example_system"),
+    HumanMessage("Jeg spiste opp grønnsakene mine", name="example_user"),
+    AIMessage("{ 'nice_score': 5 }", name="example_system"),
+    HumanMessage("Jeg har spist is.", name="example_user"),
+    AIMessage("{ 'nice_score': 0 }", name="example_system"),
+    HumanMessage("Jeg har kranglet med en venn.", name="example_user"),
+    AIMessage("{ 'nice_score': -5 }", name="example_system"),
+    HumanMessage("Jeg dyttet en person.", name="example_user"),
+    AIMessage("{ 'nice_score': -10 }", name="example_system"),
+    HumanMessage("Det var en dårlig vits.", name="example_user"),
+    AIMessage("{ 'nice_score': -5 }", name="example_system"),
+]
+
+SCORE_SCHEMA = {
+    "title": "score",
+    "description": "The score of the users action",
+    "type": "object",
+    "properties": {
+        "nice_score": {
+            "title": "Nice score",
+            "description": "The score of the action",
+            "type": "number"
+        }
+    }
+}
+
+@functools.cache
+def get_scoring_llm() -> Runnable:
+    """The structured output LLM, created once per process on first use."""
+    from langchain_openai import ChatOpenAI
+    # Retried by the LLMGateway instead, through its queue
+    return ChatOpenAI(model="gpt-4o", stream_usage=True, max_retries=0).with_structured_output(SCORE_SCHEMA)
+
+# For the rate limit reservation in the LLMGateway
+SCORING_PROMPT_TOKENS = approximate_tokens([SystemMessage(SCORING_SYSTEM_PROMPT), *SCORING_EXAMPLES])
+
+def scoring_input(name: str, action: str) -> str:
+    return f"{name}: {action}"
+
+class Scorer(Protocol):
+    def score(self, name: str, action: str, config: RunnableConfig) -> float: ...
+
+    async def ascore(self, name: str, action: str, config: RunnableConfig) -> float: ...
+
+class LLMScorer:
+    """
+    Scores actions with the structured output LLM.
+
+    The system prompt and the few-shot examples are rendered to messages
+    once, and every call sends that list followed by a single human message,
+    so no template formatting happens per call. The messages are the same as
+    those of the equivalent `ChatPromptTemplate`. At about 230 tokens the
+    prefix is below the 1024 tokens OpenAI's prompt caching starts at, so
+    nothing here is cached by the provider.
+    """
+    def __init__(self, model: Optional[Runnable] = None, priority: int = BACKGROUND):
+        """
+        Without a `model`, the chain uses `get_scoring_llm()`. `priority` is
+        the priority of the calls in the `LLMGateway` from the config:
+        `INTERACTIVE` when a chat turn waits for the score, `BACKGROUND` for
+        offline scoring like the backfill.
+        """
+        self.model = model
+        self.priority = priority
+        self._chain: Optional[Runnable] = None
+
+    @property
+    def chain(self) -> Runnable:
+        # Built on first use; two threads racing here just build the same chain twice
+        if self._chain is None:
+            model = self.model if self.model is not None else get_scoring_llm()
+            prefix: list[BaseMessage] = [SystemMessage(SCORING_SYSTEM_PROMPT), *SCORING_EXAMPLES]
+            self._chain = RunnableLambda(lambda input: [*prefix, HumanMessage(input["input"])], name="scoring_prompt") | model
+        return self._chain
+
+    def _input(self, name: str, action: str) -> dict:
+        return {"input": scoring_input(name, action)}
+
+    def _gateway_args(self, name: str, action: str) -> dict:
+        text = scoring_input(name, action)
+        # Identical requests in flight at the same time are sent once
+        return { "priority": self.priority, "tokens": SCORING_PROMPT_TOKENS + 4 + len(text) // 4, "key": ("score", id(self), text) }
+
+    def score(self, name: str, action: str, config: RunnableConfig) -> float:
+        gateway = config.get("configurable", {}).get("llm_gateway")
+        if gateway:
+            chain_res = gateway.invoke(self.chain, self._input(name, action), config, **self._gateway_args(name, action))
+        else:
+            chain_res = self.chain.invoke(self._input(name, action), config)
+        logger.debug("Nice response: %s", chain_res)
+        return float(chain_res["nice_score"])
+
+    async def ascore(self, name: str, action: str, config: RunnableConfig) -> float:
+        gateway = config.get("configurable", {}).get("llm_gateway")
+        if gateway:
+            chain_res = await gateway.ainvoke(self.chain, self._input(name, action), config, **self._gateway_args(name, action))
+        else:
+            chain_res = await self.chain.ainvoke(self._input(name, action), config)
+        logger.debug("Nice response: %s", chain_res)
+        return float(chain_res["nice_score"])
+
+class CachedScorer:
+    """Wraps another scorer with a `ScoreCache` keyed by the normalized action."""
+    def __init__(self, scorer: Scorer, cache: ScoreCache):
+        self.scorer = scorer
+        self.cache = cache
+
+    def score(self, name: str, action: str, config: RunnableConfig) -> float:
+        pool = config.get("configurable", {}).get("pool")
+        action_key = normalize_action(name, action)
+        nice_score = self.cache.get(action_key, pool)
+        if nice_score is not None:
+            logger.debug("Score cache hit: %s %s %s", action_key, nice_score, self.cache.stats())
+            return nice_score
+        nice_score = self.scorer.score(name, action, config)
+        self.cache.put(action_key, nice_score, pool)
+        return nice_score
+
+    async def ascore(self, name: str, action: str, config: RunnableConfig) -> float:
+        pool = config.get("configurable", {}).get("pool")
+        action_key = normalize_action(name, action)
+        nice_score = await self.cache.aget(action_key, pool)
+        if nice_score is not None:
+            logger.debug("Score cache hit: %s %s %s", action_key, nice_score, self.cache.stats())
+            return nice_score
+        nice_score = await self.scorer.ascore(name, action, config)
+        await self.cache.aput(action_key, nice_score, pool)
+        return nice_score
+
+class LocalScorer:
+    """
+    Deterministic scorer without any LLM call, for benchmarks and offline runs.
+
+    Scores an action by the first keyword that occurs in its normalized text,
+    and falls back to `default` otherwise.
+    """
+    def __init__(self, keywords: Optional[dict[str, float]] = None, default: float = 0):
+        self.keywords = keywords if keywords is not None else {
+            "støvsug": 5,
+            "grønnsak": 5,
+            "hjalp": 10,
+            "gave": 10,
+            "kranglet": -5,
+            "dyttet": -10,
+            "slo": -10,
+            "vits": -5,
+        }
+        self.default = default
+
+    def score(self, name: str, action: str, config: RunnableConfig) -> float:
+        text = normalize_action(name, action)
+        for keyword, nice_score in self.keywords.items():
+            if keyword in text:
+                return float(nice_score)
+        return float(self.default)
+
+    async def ascore(self, name: str, action: str, config: RunnableConfig) -> float:
+        return self.score(name, action, config)
+
+default_scorer = LLMScorer(priority=INTERACTIVE)
@@ -0,0 +1,81 @@
+"""
+Coalescing of santa's streamed tokens into frames.
+
+`graph.stream(..., stream_mode="messages")` yields one chunk per token, plus
+empty chunks for tool calls and chunks from other nodes. Every string handed
+to `st.write_stream` is a websocket delta and a re-render of the markdown
+element, so `coalesce_text`/`acoalesce_text` drop everything that is not
+santa text and join the tokens into frames:
+
+- the first token of every santa message is sent right away,
+- after that, tokens are buffered until `flush_interval` seconds have passed
+  since the last frame or `max_bytes` bytes are buffered,
+- the buffer is flushed at every chunk that is dropped (a tool call or
+  another node), since the stream may stall there, and at the end.
+
+Frames are only sent when a chunk arrives, so no extra thread or timer is needed.
+"""
+
+import time
+from typing import AsyncIterator, Callable, Iterable, Iterator, Optional
+
+def santa_text(message, metadata: dict) -> str:
+    """The text of a santa chunk, or "" for tool call chunks and chunks from other nodes."""
+    if metadata["langgraph_node"] != "santa" or not isinstance(message.content, str):
+        return ""
+    return message.content
+
+class FrameBuffer:
+    def __init__(self, flush_interval: float = 0.05, max_bytes: int = 512, clock: Callable[[], float] = time.monotonic):
+        self.flush_interval = flush_interval
+        self.max_bytes = max_bytes
+        self.clock = clock
+        self.message_id: Optional[str] = None
+        self._started = False
+        self._parts: list[str] = []
+        self._size = 0
+        self._last_flush = 0.0
+
+    def add(self, text: str, message_id: Optional[str]) -> list[str]:
+        """Buffer a token, and return the frames that are ready to be sent."""
+        if not self._started or message_id != self.message_id:
+            frames = self.flush()
+            self._started = True
+            self.message_id = message_id
+            self._last_flush = self.clock()
+            # The first token of a message is never delayed
+            return frames + [text]
+        self._parts.append(text)
+        self._size += len(text.encode())
+        if self._size >= self.max_bytes or self.clock() - self._last_flush >= self.flush_interval:
+            return self.flush()
+        return []
+
+    def flush(self) -> list[str]:
+        if not self._parts:
+            return []
+        frame = "".join(self._parts)
+        self._parts = []
+        self._size = 0
+        self._last_flush = self.clock()
+        return [frame]
+
+def coalesce_text(stream: Iterable, flush_interval: float = 0.05, max_bytes: int = 512) -> Iterator[str]:
+    """Santa's text from a (message, metadata) stream, coalesced into frames."""
+    frames = FrameBuffer(flush_interval, max_bytes)
+    for message, metadata in stream:
+        text = santa_text(message, metadata)
+        if text:
+            yield from frames.add(text, message.id)
+        else:
+            yield from frames.flush()
+    yield from frames.flush()
+
+async def acoalesce_text(stream: AsyncIterator, flush_interval: float = 0.05, max_bytes: int = 512) -> AsyncIterator[str]:
+    frames = FrameBuffer(flush_interval, max_bytes)
+    async for message, metadata in stream:
+        text = santa_text(message, metadata)
+        for frame in frames.add(text, message.id) if text else frames.flush():
+            yield frame
+    for frame in frames.flush():
+        yield frame
@@ -0,0 +1,206 @@
+"""
+Write-behind aggregation of nice score updates.
+
+Scores are grouped by first name, so popular names are a single hot row that
+every session updates. With write-behind enabled, `register_naughty_or_nice`
+only adds the delta to an in-memory buffer, and a background flusher writes
+all pending names with one `ScoreStore.add_deltas` call (a single multi-row
+upsert on Postgres), either every `flush_interval`
+seconds or as soon as `max_pending` names are buffered. Reads merge in the
+pending deltas, so a user sees their own update before it is flushed.
+
+A batch that is being flushed stays in an in-flight map until `add_deltas`
+returns, and `pending` counts it too. A read of the stored score can still
+race the commit, so `standing`/`astanding` read the score again if a flush
+of the name landed or was running while it was read.
+
+`close`/`aclose` flush whatever is left and must be called on shutdown.
+"""
+
+import asyncio
+import logging
+import threading
+import time
+from typing import Awaitable, Callable, Optional
+
+logger = logging.getLogger(__name__)
+
+# How often a read waits for a flush of its name to land
+READ_RETRY_INTERVAL = 0.005
+
+class ScoreWriteBehind:
+    def __init__(self, flush_interval: float = 1.0, max_pending: int = 100):
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.flushed_rows = 0
+        self.flushes = 0
+        # Called after every successful flush, e.g. to invalidate the leaderboard
+        self.on_flush: Optional[Callable[[], None]] = None
+        self._pending: dict[str, list[float]] = {}
+        self._in_flight: dict[str, list[float]] = {}
+        # Incremented under the lock when a flush has been committed
+        self._landed = 0
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._closed = False
+        self._thread: Optional[threading.Thread] = None
+        self._task: Optional[asyncio.Task] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._awake: Optional[asyncio.Event] = None
+
+    def add(self, name: str, delta: float):
+        with self._lock:
+            pending = self._pending.setdefault(name, [0.0, 0])
+            pending[0] += delta
+            pending[1] += 1
+            full = len(self._pending) >= self.max_pending
+        if full:
+            self._wake.set()
+            if self._loop and self._awake:
+                self._loop.call_soon_threadsafe(self._awake.set)
+
+    def _pending_locked(self, name: str) -> Optional[float]:
+        deltas = [entry[name][0] for entry in (self._pending, self._in_flight) if name in entry]
+        return sum(deltas) if deltas else None
+
+    def pending(self, name: str) -> Optional[float]:
+        """The unflushed delta for a name, including a flush in progress, or None if nothing is pending."""
+        with self._lock:
+            return self._pending_locked(name)
+
+    def _read_started(self, name: str) -> Optional[int]:
+        """The number of landed flushes, or None if the name is being flushed."""
+        with self._lock:
+            return None if name in self._in_flight else self._landed
+
+    def _read_finished(self, name: str, landed: int) -> tuple[bool, Optional[float]]:
+        """Whether a score read since `_read_started` is consistent with the pending delta, and the delta."""
+        with self._lock:
+            if self._landed != landed or name in self._in_flight:
+                return False, None
+            return True, self._pending_locked(name)
+
+    def standing(self, name: str, get: Callable[[str], Optional[float]]) -> tuple[Optional[float], Optional[float]]:
+        """The stored score from `get(name)` and the pending delta, without losing or double counting a flush."""
+        while True:
+            landed = self._read_started(name)
+            if landed is not None:
+                nice_meter = get(name)
+                consistent, pending = self._read_finished(name, landed)
+                if consistent:
+                    return nice_meter, pending
+            time.sleep(READ_RETRY_INTERVAL)
+
+    async def astanding(self, name: str, aget: Callable[[str], Awaitable[Optional[float]]]) -> tuple[Optional[float], Optional[float]]:
+        while True:
+            landed = self._read_started(name)
+            if landed is not None:
+                nice_meter = await aget(name)
+                consistent, pending = self._read_finished(name, landed)
+                if consistent:
+                    return nice_meter, pending
+            await asyncio.sleep(READ_RETRY_INTERVAL)
+
+    def _take(self) -> list[tuple[str, float, int]]:
+        with self._lock:
+            if self._in_flight:
+                # Another flush is running, and flushes one batch at a time
+                return []
+            self._in_flight, self._pending = self._pending, {}
+            batch = self._in_flight
+        return sorted((name, delta, updates) for name, (delta, updates) in batch.items())
+
+    def _land(self):
+        """Drop the in-flight batch once `add_deltas` has committed it."""
+        with self._lock:
+            self._in_flight = {}
+            self._landed += 1
+
+    def _restore(self):
+        """Put a batch that failed to flush back into the buffer, so it is retried."""
+        with self._lock:
+            for name, (delta, updates) in self._in_flight.items():
+                pending = self._pending.setdefault(name, [0.0, 0])
+                pending[0] += delta
+                pending[1] += updates
+            self._in_flight = {}
+
+    def _flushed(self, rows: list[tuple[str, float, int]]):
+        self.flushes += 1
+        self.flushed_rows += len(rows)
+        logger.debug("Write-behind flushed: %s", len(rows))
+        if self.on_flush:
+            self.on_flush()
+
+    def flush(self, score_store) -> int:
+        rows = self._take()
+        if not rows:
+            return 0
+        try:
+            score_store.add_deltas(rows)
+        except BaseException:
+            self._restore()
+            raise
+        self._land()
+        self._flushed(rows)
+        return len(rows)
+
+    async def aflush(self, score_store) -> int:
+        rows = self._take()
+        if not rows:
+            return 0
+        try:
+            await score_store.aadd_deltas(rows)
+        except BaseException:
+            self._restore()
+            raise
+        self._land()
+        self._flushed(rows)
+        return len(rows)
+
+    def start(self, score_store):
+        """Flush from a background thread, for the sync `ScoreStore` methods."""
+        def run():
+            while not self._closed:
+                self._wake.wait(self.flush_interval)
+                self._wake.clear()
+                try:
+                    self.flush(score_store)
+                except Exception:
+                    logger.exception("Write-behind flush failed")
+
+        self._thread = threading.Thread(target=run, name="write-behind", daemon=True)
+        self._thread.start()
+
+    def astart(self, score_store):
+        """Flush from a task on the running event loop, for the async `ScoreStore` methods."""
+        self._loop = asyncio.get_running_loop()
+        self._awake = asyncio.Event()
+
+        async def run():
+            while not self._closed:
+                try:
+                    await asyncio.wait_for(self._awake.wait(), self.flush_interval)
+                except asyncio.TimeoutError:
+                    pass
+                self._awake.clear()
+                try:
+                    await self.aflush(score_store)
+                except Exception:
+                    logger.exception("Write-behind flush failed")
+
+        self._task = asyncio.create_task(run())
+
+    def close(self, score_store):
+        self._closed = True
+        self._wake.set()
+        if self._thread:
+            self._thread.join()
+        self.flush(score_store)
+
+    async def aclose(self, score_store):
+        self._closed = True
+        if self._task:
+            self._awake.set()
+            await self._task
+        await self.aflush(score_store)